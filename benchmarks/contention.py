@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Load test for many writers continuing the same paragraph at once.
+
+A number of threads call Story.add_paragraph on one paragraph as fast as they
+can. The report includes the throughput, the transaction retries and failures,
+latency percentiles for continuations and for branch creations, and whether the
+branch count of the paragraph matches the number of paragraphs that continue
+it, both as displayed (with the pending counts that haven't been folded yet)
+and after folding the counter shards.
+
+The test runs against the 'sqlite' storage backend. SQLite lets one writer at a
+time hold the database, so "retries" counts the times a transaction gave up
+waiting for the lock, which is the closest the local backend gets to a
+datastore collision. To size BRANCH_COUNTER_SHARDS, look at the write rate per
+shard in the report and keep it below about one write per second for each
+shard, which is what a datastore entity group sustains.
+
+Run it from the repository root with a settings.py in src/storyteller:
+
+    python benchmarks/contention.py --writers 50 --shards 20
+
+"""
+
+import optparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark.1')
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/benchmark')
+
+from storyteller import settings
+
+# The storage backend is picked when storyteller.backends is first imported,
+# so the settings must be changed before anything else is imported.
+settings.STORAGE_BACKEND = 'sqlite'
+settings.SQLITE_DATABASE = tempfile.mktemp(suffix='.db',
+                                           prefix='storyteller-contention-')
+# The branch counter is folded by the test itself once the writers are done.
+settings.BRANCH_COUNT_FOLD_DELAY = 24 * 3600
+
+from django.utils import simplejson
+
+from storyteller import model
+from storyteller.backends import db
+
+WRITERS = 20
+WRITES = 10
+BASE_NUMBER = 5
+
+
+def percentiles(values):
+    """Returns the 50th, 90th and 99th percentile and the maximum of a list of
+    values, in milliseconds.
+
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    def at(fraction):
+        return round(values[min(int(len(values) * fraction),
+                                len(values) - 1)] * 1000, 3)
+    return {'count': len(values), 'p50_ms': at(.5), 'p90_ms': at(.9),
+            'p99_ms': at(.99), 'max_ms': round(values[-1] * 1000, 3)}
+
+class Writer(threading.Thread):
+    """Continues a paragraph a number of times, and records how long each
+    continuation took.
+
+    """
+    def __init__(self, index, story_id, number, writes, start_event):
+        threading.Thread.__init__(self)
+        self.index = index
+        self.story_id = story_id
+        self.number = number
+        self.writes = writes
+        self.start_event = start_event
+        self.continued = []
+        self.branched = []
+        self.errors = {}
+
+    def run(self):
+        self.start_event.wait()
+        for i in xrange(self.writes):
+            text = 'Writer %d continues the paragraph, take %d.' % (
+                self.index, i)
+            start = time.time()
+            try:
+                base, story, paragraph, branched = model.Story.add_paragraph(
+                    self.story_id, self.number, text)
+            except Exception, e:
+                name = e.__class__.__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+                continue
+            if branched:
+                self.branched.append(time.time() - start)
+            else:
+                self.continued.append(time.time() - start)
+
+def count_branches(story_id, number):
+    """Returns the branch count of a paragraph as displayed, with the pending
+    counts added, and as stored.
+
+    """
+    paragraph = model.Paragraph.get(db.Key.from_path(
+        'Story', story_id, 'Paragraph', str(number)))
+    records = [paragraph.get_record()]
+    model.add_pending_branches(records)
+    return records[0]['num_branches'], paragraph.num_branches
+
+def count_shards(story_id, number):
+    """Returns the write counts of the branch counter shards of a paragraph.
+
+    """
+    keys = [db.Key.from_path('BranchCounterShard',
+                             '%d:%s:%d' % (story_id, number, shard))
+            for shard in xrange(settings.BRANCH_COUNTER_SHARDS)]
+    return [shard and shard.count or 0
+            for shard in model.BranchCounterShard.get(keys)]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-w', '--writers', type='int', default=WRITERS,
+                      help='the number of concurrent writers '
+                           '[default: %default]')
+    parser.add_option('-n', '--writes', type='int', default=WRITES,
+                      help='the number of paragraphs each writer adds '
+                           '[default: %default]')
+    parser.add_option('-s', '--shards', type='int',
+                      default=settings.BRANCH_COUNTER_SHARDS,
+                      help='the number of branch counter shards '
+                           '[default: %default]')
+    parser.add_option('-t', '--timeout', type='float',
+                      default=settings.SQLITE_TIMEOUT,
+                      help='the number of seconds a transaction waits for '
+                           'the database lock [default: %default]')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results to FILE instead of stdout')
+    options, args = parser.parse_args()
+
+    settings.BRANCH_COUNTER_SHARDS = options.shards
+    settings.SQLITE_TIMEOUT = options.timeout
+
+    try:
+        # Set up a story whose paragraph already has been continued, so that
+        # every writer has to create a branch.
+        story = model.Story()
+        story.put()
+        story_id = story.key().id()
+        for number in xrange(BASE_NUMBER + 1):
+            model.Story.add_paragraph(story_id, number,
+                                      'Paragraph number %d.' % (number + 1))
+        model.fold_branch_count(story_id, BASE_NUMBER)
+        for key in db.stats:
+            db.stats[key] = 0
+
+        start_event = threading.Event()
+        writers = [Writer(i, story_id, BASE_NUMBER, options.writes,
+                          start_event)
+                   for i in xrange(options.writers)]
+        for writer in writers:
+            writer.start()
+        start = time.time()
+        start_event.set()
+        for writer in writers:
+            writer.join()
+        duration = time.time() - start
+
+        continued, branched, errors = [], [], {}
+        for writer in writers:
+            continued += writer.continued
+            branched += writer.branched
+            for name, count in writer.errors.iteritems():
+                errors[name] = errors.get(name, 0) + count
+        writes = len(continued) + len(branched)
+
+        # The paragraph was continued once during the set-up.
+        expected = writes + 1
+        actual = model.Paragraph.all().filter(
+            'follows =', db.Key.from_path('Story', story_id, 'Paragraph',
+                                          str(BASE_NUMBER))).count()
+        displayed, stored = count_branches(story_id, BASE_NUMBER)
+        shards = count_shards(story_id, BASE_NUMBER)
+        model.fold_branch_count(story_id, BASE_NUMBER)
+        folded = count_branches(story_id, BASE_NUMBER)[1]
+
+        report = {
+            'writers': options.writers,
+            'writes_per_writer': options.writes,
+            'shards': options.shards,
+            'sqlite_timeout': options.timeout,
+            'seconds': round(duration, 3),
+            'writes': writes,
+            'writes_per_second': round(writes / duration, 1),
+            'errors': errors,
+            'transactions': db.stats,
+            'latency': {'continued': percentiles(continued),
+                        'branched': percentiles(branched)},
+            'shard_writes': {
+                'max': max(shards),
+                'min': min(shards),
+                'max_per_second': round(max(shards) / duration, 2)},
+            'num_branches': {
+                'expected': expected,
+                'paragraphs': actual,
+                'displayed': displayed,
+                'stored_before_fold': stored,
+                'stored_after_fold': folded,
+                'correct': expected == actual == displayed == folded},
+        }
+
+        if options.output:
+            out = open(options.output, 'w')
+        else:
+            out = sys.stdout
+        try:
+            simplejson.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(settings.SQLITE_DATABASE + suffix):
+                os.remove(settings.SQLITE_DATABASE + suffix)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Compares the generic jsonify + simplejson.dumps serialization with the
+serializers specialized for controller data, on a story of 1,000 paragraphs.
+
+Run it from the repository root with the App Engine SDK and Django 1.1 on the
+Python path and a settings.py in src/storyteller:
+
+    python benchmarks/serialization.py
+
+"""
+
+from datetime import datetime, timedelta
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark.1')
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/benchmark')
+
+from django.utils import simplejson
+
+from storyteller import utils
+
+PARAGRAPHS = 1000
+REPEAT = 5
+NUMBER = 20
+
+
+def make_story(length):
+    """Returns story data with the given number of paragraphs, both in the
+    shape the controller used to build (with datetimes) and in the shape it
+    builds now (with timestamps).
+
+    """
+    created = datetime(2010, 5, 1, 12, 0, 0)
+    paragraphs = [{'story_id': 1 + i / 100, 'number': i + 1,
+                   'created': created + timedelta(minutes=i),
+                   'text': u'Paragraph number %d, in which something h\xe4ppens.'
+                           % (i + 1),
+                   'num_branches': i % 3}
+                  for i in xrange(length)]
+    story = {'id': 11, 'length': length,
+             'branches': [{'story_id': 1 + i, 'paragraph_number': (i + 1) * 100}
+                          for i in xrange(length / 100 - 1)],
+             'paragraphs': paragraphs}
+
+    records = [dict(p, created=utils.jsonify(p['created']))
+               for p in paragraphs]
+    return story, dict(story, paragraphs=records)
+
+def main():
+    story, records_story = make_story(PARAGRAPHS)
+
+    # Make sure both serializers produce the same data before timing them.
+    generic = simplejson.dumps(utils.jsonify(story), separators=(',', ':'))
+    specialized = utils.story_to_json(records_story)
+    assert simplejson.loads(generic) == simplejson.loads(specialized)
+
+    tests = [
+        ('jsonify + simplejson.dumps',
+         lambda: simplejson.dumps(utils.jsonify(story),
+                                  separators=(',', ':'))),
+        ('utils.story_to_json', lambda: utils.story_to_json(records_story)),
+    ]
+
+    results = []
+    for name, func in tests:
+        best = min(timeit.Timer(func).repeat(REPEAT, NUMBER)) / NUMBER
+        results.append(best)
+        print '%-30s %8.3f ms per story' % (name, best * 1000)
+    print 'Speedup: %.1fx' % (results[0] / results[1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Times the hot paths of Storyteller on a synthetic forest of stories.
+
+The forest has three parts:
+
+- A long linear story.
+- A deep chain of branches, where every branch is branched off of the one
+  before it.
+- A paragraph with a wide fan-out of branches.
+
+The suite runs against the 'sqlite' storage backend, so the datastore, memcache
+and the task queue are all local to the process. Results are written as JSON so
+that runs can be compared between releases. Each benchmark is timed both with
+empty caches ("cold") and with the caches filled by a previous call ("warm")
+where caching applies.
+
+Run it from the repository root with the App Engine SDK and Django 1.1 on the
+Python path and a settings.py in src/storyteller:
+
+    python benchmarks/suite.py --output results.json
+
+"""
+
+from cStringIO import StringIO
+import optparse
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark.1')
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/benchmark')
+
+from storyteller import settings
+
+# The storage backend is picked when storyteller.backends is first imported,
+# so the settings must be changed before anything else is imported.
+settings.STORAGE_BACKEND = 'sqlite'
+settings.SQLITE_DATABASE = tempfile.mktemp(suffix='.db',
+                                           prefix='storyteller-benchmark-')
+# Keep the branch counter folds from running in the middle of the benchmarks.
+settings.BRANCH_COUNT_FOLD_DELAY = 24 * 3600
+
+# Sets up Django 1.1 and the template filters, like a request would.
+import app
+
+from django.utils import simplejson
+from google.appengine.ext import webapp
+
+from storyteller import cache, controller, model, urls
+from storyteller.backends import db, memcache
+
+LINEAR_LENGTH = 1000
+CHAIN_DEPTH = 50
+CHAIN_BRANCH_LENGTH = 10
+FAN_OUT_WIDTH = 200
+ITERATIONS = 50
+
+WORDS = ('the', 'a', 'dragon', 'castle', 'forest', 'wandered', 'into',
+         'quietly', 'old', 'map', 'suddenly', 'river', 'knight', 'found',
+         'lantern', 'under', 'stars', 'and', 'her', 'his', 'whispered')
+
+
+class Forest(object):
+    """Generates the synthetic stories that the benchmarks run against.
+
+    """
+    def __init__(self, scale=1.0, seed=0):
+        self.random = random.Random(seed)
+        self.linear_length = max(int(LINEAR_LENGTH * scale), 2)
+        self.chain_depth = max(int(CHAIN_DEPTH * scale), 1)
+        self.fan_out_width = max(int(FAN_OUT_WIDTH * scale), 1)
+
+    def text(self):
+        """Returns the text of a random paragraph.
+
+        """
+        words = [self.random.choice(WORDS)
+                 for i in xrange(self.random.randint(5, 30))]
+        return ' '.join(words).capitalize() + '.'
+
+    def create_story(self, length):
+        """Creates a story with the specified number of paragraphs, and returns
+        its id.
+
+        """
+        story = model.Story()
+        story.put()
+        story_id = story.key().id()
+        self.extend(story_id, 0, length)
+        return story_id
+
+    def extend(self, story_id, length, count):
+        """Adds a number of paragraphs to the end of a story.
+
+        """
+        for number in xrange(length, length + count):
+            model.Story.add_paragraph(story_id, number, self.text())
+
+    def branch(self, story_id, number):
+        """Continues the specified paragraph of a story, which has already been
+        continued, and returns the id of the branch created.
+
+        """
+        base, story, paragraph, branched = model.Story.add_paragraph(
+            story_id, number, self.text())
+        assert branched
+        return story.key().id()
+
+    def generate(self):
+        self.linear_id = self.create_story(self.linear_length)
+
+        # Every branch continues from the second to last paragraph of the
+        # branch before it, and then gets a few paragraphs of its own.
+        story_id = self.create_story(CHAIN_BRANCH_LENGTH)
+        length = CHAIN_BRANCH_LENGTH
+        for i in xrange(self.chain_depth):
+            story_id = self.branch(story_id, length - 1)
+            self.extend(story_id, length, CHAIN_BRANCH_LENGTH - 1)
+            length += CHAIN_BRANCH_LENGTH - 1
+        self.chain_id = story_id
+        self.chain_length = length
+
+        self.fan_out_id = self.create_story(CHAIN_BRANCH_LENGTH)
+        self.fan_out_number = CHAIN_BRANCH_LENGTH / 2
+        for i in xrange(self.fan_out_width):
+            self.branch(self.fan_out_id, self.fan_out_number)
+
+        self.append_id = self.create_story(1)
+        self.append_length = 1
+
+    def describe(self):
+        return {'linear_length': self.linear_length,
+                'chain_depth': self.chain_depth,
+                'chain_length': self.chain_length,
+                'fan_out_width': self.fan_out_width}
+
+
+def clear_caches():
+    cache.local.clear()
+    memcache.flush_all()
+
+def get_url(application, path):
+    """Requests a path from the application and returns the response body.
+
+    """
+    environ = {'REQUEST_METHOD': 'GET',
+               'SCRIPT_NAME': '',
+               'PATH_INFO': path,
+               'QUERY_STRING': '',
+               'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80',
+               'SERVER_PROTOCOL': 'HTTP/1.0',
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': 'http',
+               'wsgi.input': StringIO(),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': False,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    status = []
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+    body = ''.join(application(environ, start_response))
+    if not status[0].startswith('200'):
+        raise AssertionError('GET %s returned %s' % (path, status[0]))
+    return body
+
+def get_benchmarks(forest):
+    """Returns a list of (name, setup, func, warm) tuples. The setup function
+    is called before every call to func, and is not timed. If warm is True,
+    func is called once before timing starts.
+
+    """
+    application = webapp.WSGIApplication(urls.urlpatterns)
+    page_start = max(forest.linear_length - settings.PAGE_SIZE + 1, 1)
+    no_setup = lambda: None
+
+    def append():
+        model.Story.add_paragraph(forest.append_id, forest.append_length,
+                                  forest.text())
+        forest.append_length += 1
+
+    benchmarks = [
+        ('model.Paragraph.get_range/linear/all', no_setup,
+         lambda: model.Paragraph.get_range(forest.linear_id), False),
+        ('model.Paragraph.get_range/linear/last_page', no_setup,
+         lambda: model.Paragraph.get_range(forest.linear_id, page_start),
+         False),
+        ('model.Paragraph.get_range/chain/all', no_setup,
+         lambda: model.Paragraph.get_range(forest.chain_id), False),
+    ]
+
+    reads = [
+        ('controller.get_story/linear',
+         lambda: controller.get_story(None, forest.linear_id)),
+        ('controller.get_story/chain',
+         lambda: controller.get_story(None, forest.chain_id)),
+        ('controller.get_paragraph/fan_out',
+         lambda: controller.get_paragraph(None, forest.fan_out_id,
+                                          forest.fan_out_number)),
+        ('view.StoryHandler/linear',
+         lambda: get_url(application, '/%d' % forest.linear_id)),
+        ('view.StoryHandler/chain',
+         lambda: get_url(application, '/%d' % forest.chain_id)),
+        ('view.StoryHandler/fan_out',
+         lambda: get_url(application, '/%d/%d' % (forest.fan_out_id,
+                                                  forest.fan_out_number))),
+    ]
+    for name, func in reads:
+        benchmarks.append((name + '/cold', clear_caches, func, False))
+        benchmarks.append((name + '/warm', no_setup, func, True))
+
+    # Writes go last since they change the data that the reads above use.
+    benchmarks += [
+        ('model.Story.add_paragraph/append', no_setup, append, False),
+        ('model.Story.add_paragraph/branch', no_setup,
+         lambda: forest.branch(forest.fan_out_id, forest.fan_out_number),
+         False),
+    ]
+    return benchmarks
+
+def run(setup, func, warm, iterations):
+    """Times a number of calls to func, and returns statistics on the time
+    taken, in milliseconds.
+
+    """
+    if warm:
+        func()
+
+    times = []
+    for i in xrange(iterations):
+        setup()
+        start = time.time()
+        func()
+        times.append((time.time() - start) * 1000)
+
+    times.sort()
+    return {'iterations': iterations,
+            'min_ms': round(times[0], 3),
+            'median_ms': round(times[len(times) / 2], 3),
+            'mean_ms': round(sum(times) / len(times), 3),
+            'max_ms': round(times[-1], 3)}
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help='write the results to FILE instead of stdout')
+    parser.add_option('-n', '--iterations', type='int', default=ITERATIONS,
+                      help='the number of timed calls per benchmark '
+                           '[default: %default]')
+    parser.add_option('-s', '--scale', type='float', default=1.0,
+                      help='multiply the size of the generated forest by '
+                           'SCALE [default: %default]')
+    parser.add_option('-k', '--only', action='append', default=[],
+                      metavar='TEXT',
+                      help='only run the benchmarks whose names contain TEXT; '
+                           'may be given more than once')
+    options, args = parser.parse_args()
+
+    try:
+        forest = Forest(options.scale)
+        start = time.time()
+        forest.generate()
+        generate_time = time.time() - start
+
+        results = []
+        for name, setup, func, warm in get_benchmarks(forest):
+            if options.only and not [text for text in options.only
+                                     if text in name]:
+                continue
+            result = run(setup, func, warm, options.iterations)
+            result['name'] = name
+            results.append(result)
+            print >>sys.stderr, '%-48s %10.3f ms' % (name, result['median_ms'])
+
+        report = {'version': settings.VERSION,
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'time': int(time.time()),
+                  'backend': settings.STORAGE_BACKEND,
+                  'page_size': settings.PAGE_SIZE,
+                  'forest': forest.describe(),
+                  'generate_seconds': round(generate_time, 3),
+                  'db_stats': db.stats,
+                  'cache_stats': cache.stats,
+                  'benchmarks': results}
+        if options.output:
+            out = open(options.output, 'w')
+        else:
+            out = sys.stdout
+        try:
+            simplejson.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(settings.SQLITE_DATABASE + suffix):
+                os.remove(settings.SQLITE_DATABASE + suffix)
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,8 @@ use_library('django', '1.1')
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template, util
 
+import storyteller.metrics
+import storyteller.profiler
 import storyteller.settings
 import storyteller.urls
 
@@ -48,8 +50,10 @@ def main():
         storyteller.urls.urlpatterns,
         debug=storyteller.settings.DEBUG)
 
-    # Run the WSGI CGI handler with the application.
-    util.run_wsgi_app(application)
+    # Run the WSGI CGI handler with the application, measuring every request
+    # and profiling some of them.
+    util.run_wsgi_app(storyteller.metrics.middleware(
+        storyteller.profiler.middleware(application)))
 
 if __name__ == '__main__':
     main()
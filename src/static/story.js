@@ -1,7 +1,40 @@
+// Turns the lists of records that the API sends as columns in its compact
+// format back into arrays of objects.
+function expand(value) {
+    if (!value || typeof value != 'object') return value;
+
+    if (value instanceof Array) {
+        for (var i = 0; i < value.length; i++) {
+            value[i] = expand(value[i]);
+        }
+        return value;
+    }
+
+    if ('_compact' in value) {
+        var records = [];
+        for (var i = 0; i < value._compact; i++) {
+            var record = {};
+            for (var name in value) {
+                if (name == '_compact') continue;
+                var column = value[name];
+                record[name] = column instanceof Array ? column[i] : column;
+            }
+            records.push(record);
+        }
+        return records;
+    }
+
+    for (var name in value) {
+        value[name] = expand(value[name]);
+    }
+    return value;
+}
+
 function api(method, args, success, error) {
     for (var name in args) {
         args[name] = JSON.stringify(args[name]);
     }
+    args._format = 'compact';
 
     var options = {
         url: '/api/' + method,
@@ -11,8 +44,12 @@ function api(method, args, success, error) {
 
     if (success) {
         options.success = function (data) {
-            if (data.status == 'success') return success(data);
-            if (error) return error(data);
+            if (data.status != 'success') {
+                if (error) return error(data);
+                return;
+            }
+            data.response = expand(data.response);
+            return success(data);
         };
     }
 
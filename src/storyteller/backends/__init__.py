@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Storage backends for Storyteller.
+
+The rest of the application imports db, memcache and taskqueue from this
+package instead of from the App Engine SDK. Which implementations are used is
+decided by the STORAGE_BACKEND setting:
+
+- 'appengine': The App Engine datastore, memcache and task queue.
+- 'sqlite': A local SQLite database (the SQLITE_DATABASE setting) that
+  implements the parts of the datastore API that Storyteller uses, together
+  with in-process stand-ins for memcache and the task queue. This lets the
+  datastore, memcache and the task queue run locally in a single process;
+  the App Engine SDK and Django 1.1 are still needed for webapp, users and
+  the templates.
+
+"""
+
+from storyteller import settings
+
+if settings.STORAGE_BACKEND == 'sqlite':
+    from storyteller.backends import sqlite as db
+    from storyteller.backends import local_memcache as memcache
+    from storyteller.backends import local_taskqueue as taskqueue
+elif settings.STORAGE_BACKEND == 'appengine':
+    from google.appengine.api import memcache
+    try:
+        from google.appengine.api import taskqueue
+    except ImportError:
+        from google.appengine.api.labs import taskqueue
+    from google.appengine.ext import db
+else:
+    raise ValueError('Unknown storage backend: %r' % settings.STORAGE_BACKEND)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""An in-process stand-in for the App Engine memcache API, for running
+Storyteller outside of App Engine. Only the functions that Storyteller uses
+are implemented.
+
+Values are pickled when they are stored, so that changing a value after
+storing it (or after getting it) doesn't change the cached value. Unlike
+memcache, the cache is not shared between processes and is never evicted
+because of memory pressure; expired values are purged as the cache grows.
+
+"""
+
+import cPickle as pickle
+import threading
+import time
+
+# Expiration times larger than this are absolute UNIX timestamps instead of
+# relative numbers of seconds, same as in memcache.
+_MAX_RELATIVE_TIME = 30 * 24 * 60 * 60
+
+# Purge expired values every this many writes.
+_PURGE_INTERVAL = 10000
+
+_lock = threading.RLock()
+_values = {}
+_writes = [0]
+
+
+def _expires(time_):
+    if not time_:
+        return None
+    if time_ > _MAX_RELATIVE_TIME:
+        return time_
+    return time.time() + time_
+
+def _get(key):
+    entry = _values.get(key)
+    if entry is None:
+        return None
+    data, expires = entry
+    if expires is not None and expires <= time.time():
+        del _values[key]
+        return None
+    return entry
+
+def _set(key, value, time_):
+    _writes[0] += 1
+    if _writes[0] % _PURGE_INTERVAL == 0:
+        now = time.time()
+        for k, (data, expires) in _values.items():
+            if expires is not None and expires <= now:
+                del _values[k]
+    _values[key] = (pickle.dumps(value, 2), _expires(time_))
+
+def get(key, namespace=None):
+    _lock.acquire()
+    try:
+        entry = _get(key)
+    finally:
+        _lock.release()
+    if entry is None:
+        return None
+    return pickle.loads(entry[0])
+
+def get_multi(keys, key_prefix='', namespace=None):
+    results = {}
+    _lock.acquire()
+    try:
+        for key in keys:
+            entry = _get(key_prefix + key)
+            if entry is not None:
+                results[key] = entry[0]
+    finally:
+        _lock.release()
+    return dict((key, pickle.loads(data))
+                for key, data in results.iteritems())
+
+def set(key, value, time=0, namespace=None):
+    _lock.acquire()
+    try:
+        _set(key, value, time)
+    finally:
+        _lock.release()
+    return True
+
+def set_multi(mapping, time=0, key_prefix='', namespace=None):
+    _lock.acquire()
+    try:
+        for key, value in mapping.iteritems():
+            _set(key_prefix + key, value, time)
+    finally:
+        _lock.release()
+    return []
+
+def add(key, value, time=0, namespace=None):
+    _lock.acquire()
+    try:
+        if _get(key) is not None:
+            return False
+        _set(key, value, time)
+        return True
+    finally:
+        _lock.release()
+
+def add_multi(mapping, time=0, key_prefix='', namespace=None):
+    failed = []
+    _lock.acquire()
+    try:
+        for key, value in mapping.iteritems():
+            if _get(key_prefix + key) is not None:
+                failed.append(key)
+            else:
+                _set(key_prefix + key, value, time)
+    finally:
+        _lock.release()
+    return failed
+
+def delete(key, seconds=0, namespace=None):
+    _lock.acquire()
+    try:
+        if _values.pop(key, None) is None:
+            return 1
+        return 2
+    finally:
+        _lock.release()
+
+def delete_multi(keys, seconds=0, key_prefix='', namespace=None):
+    _lock.acquire()
+    try:
+        for key in keys:
+            _values.pop(key_prefix + key, None)
+    finally:
+        _lock.release()
+    return True
+
+def _offset(key, delta, initial_value):
+    entry = _get(key)
+    if entry is None:
+        if initial_value is None:
+            return None
+        value, expires = initial_value, None
+    else:
+        value, expires = pickle.loads(entry[0]), entry[1]
+        if not isinstance(value, (int, long)):
+            raise ValueError('Cannot increment a non-integer value.')
+    # Like memcache, values never go below zero.
+    value = max(0, value + delta)
+    _values[key] = (pickle.dumps(value, 2), expires)
+    return value
+
+def incr(key, delta=1, namespace=None, initial_value=None):
+    _lock.acquire()
+    try:
+        return _offset(key, delta, initial_value)
+    finally:
+        _lock.release()
+
+def decr(key, delta=1, namespace=None, initial_value=None):
+    _lock.acquire()
+    try:
+        return _offset(key, -delta, initial_value)
+    finally:
+        _lock.release()
+
+def offset_multi(mapping, key_prefix='', namespace=None, initial_value=None):
+    _lock.acquire()
+    try:
+        return dict((key, _offset(key_prefix + key, delta, initial_value))
+                    for key, delta in mapping.iteritems())
+    finally:
+        _lock.release()
+
+def flush_all():
+    _lock.acquire()
+    try:
+        _values.clear()
+    finally:
+        _lock.release()
+    return True
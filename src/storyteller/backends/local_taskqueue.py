@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""An in-process stand-in for the App Engine task queue API, for running
+Storyteller outside of App Engine. Only the parts that Storyteller uses are
+implemented.
+
+Tasks are run in order of their ETA on a single worker thread, by posting
+their parameters to the application in storyteller.urls, like the task queue
+does. Named tasks are only run once per process.
+
+Queued tasks are also written to a table in the SQLite database (the
+SQLITE_DATABASE setting) until they have run, so that tasks that were queued
+when the process exited are run when it starts again. Without that, the
+branch counts and votes that had not been folded yet would never be.
+
+Requests from the queue carry a header with a secret that is made up for
+each process (see is_task_request), since outside of App Engine there is
+nothing that keeps anyone else from sending requests to the task URLs.
+
+"""
+
+from cStringIO import StringIO
+import cPickle as pickle
+import heapq
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import urllib
+
+from storyteller import settings
+
+
+class Error(Exception):
+    """Base class for task queue errors."""
+
+class TaskAlreadyExistsError(Error):
+    """Raised when a task is added with a name that is already queued."""
+
+class TombstonedTaskError(Error):
+    """Raised when a task is added with the name of a task that has already
+    run.
+
+    """
+
+# The number of seconds that the names of tasks that have run are remembered.
+TOMBSTONE_TIME = 3600
+
+# The header that requests from the queue carry the secret in.
+TASK_HEADER = 'X-Storyteller-Task'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    eta REAL NOT NULL,
+    url TEXT NOT NULL,
+    params BLOB NOT NULL
+);
+"""
+
+_secret = os.urandom(16).encode('hex')
+
+# Guards everything below, including the connection.
+_lock = threading.Condition()
+_queued = set()
+_tombstones = {}
+# A heap of (eta, id, name, url, params) tuples, where id is the id of the
+# row that the task is stored in.
+_tasks = []
+_connection = None
+_worker = None
+
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(settings.SQLITE_DATABASE,
+                                      timeout=settings.SQLITE_TIMEOUT,
+                                      isolation_level=None,
+                                      check_same_thread=False)
+        _connection.text_factory = str
+        _connection.executescript(_SCHEMA)
+    return _connection
+
+def _start():
+    """Starts the worker thread, if it hasn't been started. Must be called
+    with the lock held.
+
+    """
+    global _worker
+    if not _worker:
+        _worker = threading.Thread(target=_work)
+        _worker.setDaemon(True)
+        _worker.start()
+
+def _restore():
+    """Queues the tasks that were stored by an earlier process, but never
+    run.
+
+    """
+    _lock.acquire()
+    try:
+        rows = _get_connection().execute(
+            'SELECT id, name, eta, url, params FROM tasks').fetchall()
+        for id, name, eta, url, params in rows:
+            if name:
+                _queued.add(name)
+                _tombstones[name] = time.time()
+            heapq.heappush(_tasks, (eta, id, name, url,
+                                    pickle.loads(str(params))))
+        if rows:
+            logging.info('Restored %d queued tasks.', len(rows))
+            _start()
+    finally:
+        _lock.release()
+
+def is_task_request(request):
+    """Returns True if a request was sent by this queue.
+
+    """
+    return request.headers.get(TASK_HEADER) == _secret
+
+def _run(id, name, url, params):
+    # Imported here since the application imports this module.
+    from google.appengine.ext import webapp
+    from storyteller import urls
+
+    body = urllib.urlencode(params)
+    environ = {'REQUEST_METHOD': 'POST',
+               'SCRIPT_NAME': '',
+               'PATH_INFO': url,
+               'QUERY_STRING': '',
+               'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+               'CONTENT_LENGTH': str(len(body)),
+               'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80',
+               'SERVER_PROTOCOL': 'HTTP/1.0',
+               'HTTP_X_APPENGINE_TASKNAME': name or '',
+               'HTTP_X_STORYTELLER_TASK': _secret,
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': 'http',
+               'wsgi.input': StringIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    status = []
+    try:
+        application = webapp.WSGIApplication(urls.urlpatterns)
+        def start_response(s, headers, exc_info=None):
+            status.append(s)
+        application(environ, start_response)
+        if not status or not status[0].startswith('2'):
+            logging.error('Task %s (%s) failed: %s', name, url,
+                          status and status[0])
+    except:
+        logging.exception('Task %s (%s) failed:', name, url)
+    finally:
+        _lock.acquire()
+        try:
+            _queued.discard(name)
+            _get_connection().execute('DELETE FROM tasks WHERE id = ?', (id,))
+        finally:
+            _lock.release()
+
+def _work():
+    while True:
+        _lock.acquire()
+        try:
+            while True:
+                now = time.time()
+                if not _tasks:
+                    _lock.wait()
+                elif _tasks[0][0] > now:
+                    _lock.wait(_tasks[0][0] - now)
+                else:
+                    task = heapq.heappop(_tasks)
+                    break
+        finally:
+            _lock.release()
+        _run(*task[1:])
+
+def add(url, params=None, name=None, countdown=0, queue_name='default',
+        **kwargs):
+    """Queues a task that posts the specified parameters to a URL of the
+    application after countdown seconds.
+
+    """
+    _lock.acquire()
+    try:
+        now = time.time()
+        if name:
+            if name in _queued:
+                raise TaskAlreadyExistsError('Task %s is already queued.' %
+                                             name)
+            if len(_tombstones) > 10000:
+                for old_name, added in _tombstones.items():
+                    if added < now - TOMBSTONE_TIME:
+                        del _tombstones[old_name]
+            if name in _tombstones:
+                raise TombstonedTaskError('Task %s has already run.' % name)
+            _queued.add(name)
+            _tombstones[name] = now
+
+        eta = now + (countdown or 0)
+        params = dict(params or {})
+        id = _get_connection().execute(
+            'INSERT INTO tasks (name, eta, url, params) VALUES (?, ?, ?, ?)',
+            (name, eta, url, buffer(pickle.dumps(params, 2)))).lastrowid
+        heapq.heappush(_tasks, (eta, id, name, url, params))
+        _start()
+        _lock.notify()
+    finally:
+        _lock.release()
+
+_restore()
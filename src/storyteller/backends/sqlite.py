@@ -0,0 +1,877 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""A storage engine that implements the parts of the App Engine datastore API
+(google.appengine.ext.db) that Storyteller uses, on top of SQLite.
+
+Entities are stored pickled in a single table keyed by their full key path,
+which makes ancestor queries range scans on the primary key. Indexed property
+values are copied to a separate table with an index on (kind, name, value),
+which serves equality and inequality filters and sort orders, such as the
+number of a paragraph or the paragraph it follows.
+
+The database runs in WAL mode so that readers never block the writer.
+Transactions lock the whole database, which is stricter than the entity group
+transactions of the datastore but gives the same guarantees.
+
+"""
+
+from datetime import datetime
+import calendar
+import cPickle as pickle
+import random
+import sqlite3
+import threading
+import time
+import urllib
+
+from storyteller import settings
+
+# The number of times a transaction is retried when the database is locked by
+# another writer, same as the datastore.
+DEFAULT_TRANSACTION_RETRIES = 3
+
+# Counters for the transactions run by this process. "retries" counts the
+# attempts that failed because another writer held the database.
+stats = {'transactions': 0, 'retries': 0, 'failures': 0}
+
+# Functions that are called before every datastore call, with the same
+# arguments as the pre-call hooks of the App Engine API proxy.
+hooks = []
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS properties (
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS properties_by_value
+    ON properties (kind, name, value, key);
+CREATE INDEX IF NOT EXISTS properties_by_key ON properties (key);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class Error(Exception):
+    """Base class for datastore errors."""
+
+class BadValueError(Error):
+    """Raised when a property is given an invalid value."""
+
+class BadArgumentError(Error):
+    """Raised when a query or key is given invalid arguments."""
+
+class BadRequestError(Error):
+    """Raised when an operation is not allowed, such as nested
+    transactions.
+
+    """
+
+class NotSavedError(Error):
+    """Raised when the key of an entity without one is requested."""
+
+class KindError(Error):
+    """Raised when an entity of the wrong kind is fetched."""
+
+class Rollback(Error):
+    """Raise in a transaction function to roll back the transaction without
+    an error.
+
+    """
+
+class TransactionFailedError(Error):
+    """Raised when a transaction could not be committed."""
+
+
+class Blob(str):
+    """A string of bytes. Never indexed."""
+
+class Text(unicode):
+    """A long string. Never indexed."""
+
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_created = set()
+
+def _get_connection():
+    """Returns the connection of the current thread, creating the database
+    schema the first time.
+
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        path = settings.SQLITE_DATABASE
+        # Transactions are managed manually, so the sqlite3 module must not
+        # start any on its own.
+        connection = sqlite3.connect(path, timeout=settings.SQLITE_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        connection.text_factory = str
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        _schema_lock.acquire()
+        try:
+            if path not in _schema_created:
+                connection.executescript(_SCHEMA)
+                _schema_created.add(path)
+        finally:
+            _schema_lock.release()
+        _local.connection = connection
+        _local.in_transaction = False
+    return connection
+
+def _in_transaction():
+    return getattr(_local, 'in_transaction', False)
+
+def _write(statements):
+    """Runs a list of (sql, parameters) tuples atomically.
+
+    """
+    connection = _get_connection()
+    if _in_transaction():
+        for sql, parameters in statements:
+            connection.execute(sql, parameters)
+        return
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        for sql, parameters in statements:
+            connection.execute(sql, parameters)
+    except:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+
+def _allocate_id():
+    connection = _get_connection()
+    if not _in_transaction():
+        connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute(
+            "INSERT OR IGNORE INTO counters VALUES ('id', 0)")
+        connection.execute(
+            "UPDATE counters SET value = value + 1 WHERE name = 'id'")
+        value = connection.execute(
+            "SELECT value FROM counters WHERE name = 'id'").fetchone()[0]
+    except:
+        if not _in_transaction():
+            connection.execute('ROLLBACK')
+        raise
+    if not _in_transaction():
+        connection.execute('COMMIT')
+    return value
+
+
+class Key(object):
+    """The key of an entity: a path of (kind, id or name) pairs, starting with
+    the root entity.
+
+    """
+    def __init__(self, encoded=None):
+        self._path = ()
+        if encoded:
+            path = []
+            for part in encoded.split('/'):
+                kind, value = part.split(':', 1)
+                if value.startswith('i'):
+                    path.append((kind, int(value[1:])))
+                else:
+                    path.append((kind, urllib.unquote(value[1:])))
+            self._path = tuple(path)
+
+    @classmethod
+    def from_path(cls, *args, **kwargs):
+        parent = kwargs.get('parent')
+        if len(args) % 2:
+            raise BadArgumentError('Key paths must have an even length.')
+        path = list(parent._path if parent else ())
+        for i in xrange(0, len(args), 2):
+            kind, value = args[i], args[i + 1]
+            if isinstance(kind, type) and issubclass(kind, Model):
+                kind = kind.kind()
+            if isinstance(value, (int, long)):
+                if value <= 0:
+                    raise BadArgumentError('Ids must be positive.')
+            elif isinstance(value, basestring):
+                if not value:
+                    raise BadArgumentError('Names must not be empty.')
+                value = str(value)
+            elif value is not None:
+                raise BadArgumentError('Invalid id or name: %r' % value)
+            path.append((kind, value))
+        key = cls()
+        key._path = tuple(path)
+        return key
+
+    def _encode(self):
+        # Encoded keys are compared as strings by the queries, so ids are
+        # padded to the digits of the largest id (2 ** 63 - 1) to sort them
+        # by their value, like the datastore does.
+        parts = []
+        for kind, value in self._path:
+            if isinstance(value, (int, long)):
+                parts.append('%s:i%019d' % (kind, value))
+            else:
+                parts.append('%s:n%s' % (kind, urllib.quote(value, '')))
+        return '/'.join(parts)
+
+    def kind(self):
+        return self._path[-1][0]
+
+    def id(self):
+        value = self._path[-1][1]
+        return value if isinstance(value, (int, long)) else None
+
+    def name(self):
+        value = self._path[-1][1]
+        return value if isinstance(value, basestring) else None
+
+    def id_or_name(self):
+        return self._path[-1][1]
+
+    def has_id_or_name(self):
+        return self._path[-1][1] is not None
+
+    def parent(self):
+        if len(self._path) < 2:
+            return None
+        key = Key()
+        key._path = self._path[:-1]
+        return key
+
+    def to_path(self):
+        path = []
+        for pair in self._path:
+            path.extend(pair)
+        return path
+
+    def __str__(self):
+        return self._encode()
+
+    def __repr__(self):
+        return 'datastore_types.Key.from_path(%s)' % ', '.join(
+            repr(value) for value in self.to_path())
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self._path == other._path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __cmp__(self, other):
+        return cmp(self._path, other._path)
+
+    def __hash__(self):
+        return hash(self._path)
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._path = state
+
+
+class Property(object):
+    """A property of a model. Only the parts of the datastore API that
+    Storyteller uses are supported.
+
+    """
+    data_type = object
+
+    def __init__(self, verbose_name=None, name=None, default=None,
+                 required=False, indexed=True):
+        self.verbose_name = verbose_name
+        self.name = name
+        self.default = default
+        self.required = required
+        self.indexed = indexed
+
+    def __property_config__(self, model_class, property_name):
+        self.model_class = model_class
+        if self.name is None:
+            self.name = property_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._values.get(self.name)
+
+    def __set__(self, instance, value):
+        instance._values[self.name] = self.validate(value)
+
+    def default_value(self):
+        return self.default
+
+    def validate(self, value):
+        if value is None:
+            if self.required:
+                raise BadValueError('Property %s is required.' % self.name)
+            return None
+        if not isinstance(value, self.data_type):
+            raise BadValueError('Property %s must be a %s.' % (
+                self.name, getattr(self.data_type, '__name__', 'value')))
+        return value
+
+    def get_value_for_datastore(self, instance):
+        return instance._values.get(self.name)
+
+    def make_value_from_datastore(self, value):
+        return value
+
+class IntegerProperty(Property):
+    data_type = (int, long)
+
+    def validate(self, value):
+        if isinstance(value, bool):
+            raise BadValueError('Property %s must be an int.' % self.name)
+        return super(IntegerProperty, self).validate(value)
+
+class FloatProperty(Property):
+    data_type = float
+
+class BooleanProperty(Property):
+    data_type = bool
+
+class StringProperty(Property):
+    data_type = basestring
+
+class TextProperty(Property):
+    data_type = basestring
+
+    def __init__(self, *args, **kwargs):
+        kwargs['indexed'] = False
+        super(TextProperty, self).__init__(*args, **kwargs)
+
+    def validate(self, value):
+        value = super(TextProperty, self).validate(value)
+        if value is not None and not isinstance(value, Text):
+            value = Text(value)
+        return value
+
+class BlobProperty(Property):
+    data_type = str
+
+    def __init__(self, *args, **kwargs):
+        kwargs['indexed'] = False
+        super(BlobProperty, self).__init__(*args, **kwargs)
+
+    def validate(self, value):
+        value = super(BlobProperty, self).validate(value)
+        if value is not None and not isinstance(value, Blob):
+            value = Blob(value)
+        return value
+
+class DateTimeProperty(Property):
+    data_type = datetime
+
+    def __init__(self, verbose_name=None, auto_now=False, auto_now_add=False,
+                 **kwargs):
+        super(DateTimeProperty, self).__init__(verbose_name, **kwargs)
+        self.auto_now = auto_now
+        self.auto_now_add = auto_now_add
+
+    def default_value(self):
+        if self.auto_now or self.auto_now_add:
+            return datetime.utcnow()
+        return super(DateTimeProperty, self).default_value()
+
+    def get_value_for_datastore(self, instance):
+        if self.auto_now:
+            instance._values[self.name] = datetime.utcnow()
+        return super(DateTimeProperty, self).get_value_for_datastore(instance)
+
+class ListProperty(Property):
+    data_type = list
+
+    def __init__(self, item_type, verbose_name=None, default=None, **kwargs):
+        if default is None:
+            default = []
+        self.item_type = item_type
+        super(ListProperty, self).__init__(verbose_name, default=default,
+                                           **kwargs)
+
+    def default_value(self):
+        return list(self.default)
+
+    def validate(self, value):
+        value = super(ListProperty, self).validate(value)
+        if value is None:
+            raise BadValueError('Property %s must be a list.' % self.name)
+        item_type = (int, long) if self.item_type in (int, long) else \
+            self.item_type
+        for item in value:
+            if not isinstance(item, item_type):
+                raise BadValueError('Items of property %s must be %s.' % (
+                    self.name, self.item_type.__name__))
+        return value
+
+class ReferenceProperty(Property):
+    """A reference to another entity. Setting a collection name adds a query
+    for the entities that refer to an entity to the referenced model.
+
+    """
+    def __init__(self, reference_class=None, verbose_name=None,
+                 collection_name=None, **kwargs):
+        super(ReferenceProperty, self).__init__(verbose_name, **kwargs)
+        self.reference_class = reference_class
+        self.collection_name = collection_name
+
+    def __property_config__(self, model_class, property_name):
+        super(ReferenceProperty, self).__property_config__(model_class,
+                                                           property_name)
+        if self.reference_class is _SELF_REFERENCE:
+            self.reference_class = model_class
+        if self.collection_name is None:
+            self.collection_name = '%s_set' % model_class.__name__.lower()
+        setattr(self.reference_class, self.collection_name,
+                _ReverseReferenceProperty(model_class, self.name))
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance._values.get(self.name)
+        if isinstance(value, Key):
+            value = get(value)
+            instance._values[self.name] = value
+        return value
+
+    def validate(self, value):
+        if isinstance(value, Model):
+            if not value.has_key():
+                raise BadValueError('Referenced entities must be saved.')
+            return value
+        if value is not None and not isinstance(value, Key):
+            raise BadValueError('Property %s must be a key or an entity.' %
+                                self.name)
+        return super(ReferenceProperty, self).validate(value)
+
+    def get_value_for_datastore(self, instance):
+        value = instance._values.get(self.name)
+        if isinstance(value, Model):
+            return value.key()
+        return value
+
+_SELF_REFERENCE = object()
+
+def SelfReferenceProperty(verbose_name=None, collection_name=None, **kwargs):
+    return ReferenceProperty(_SELF_REFERENCE, verbose_name, collection_name,
+                             **kwargs)
+
+class _ReverseReferenceProperty(object):
+    def __init__(self, model_class, property_name):
+        self.model_class = model_class
+        self.property_name = property_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return self.model_class.all().filter('%s =' % self.property_name,
+                                             instance.key())
+
+
+# All model classes by kind, so that entities can be loaded as instances of
+# the right class.
+_models = {}
+
+class PropertiedClass(type):
+    def __init__(cls, name, bases, dct):
+        super(PropertiedClass, cls).__init__(name, bases, dct)
+        _models[name] = cls
+        cls._properties = {}
+        for base in reversed(cls.__mro__[1:]):
+            cls._properties.update(getattr(base, '_properties', {}))
+        for attr_name, attr in dct.items():
+            if isinstance(attr, Property):
+                attr.__property_config__(cls, attr_name)
+                cls._properties[attr.name] = attr
+
+class Model(object):
+    """A model with the subset of the datastore API that Storyteller uses.
+
+    """
+    __metaclass__ = PropertiedClass
+
+    def __init__(self, parent=None, key_name=None, key=None, _from_entity=None,
+                 **kwargs):
+        if isinstance(parent, Model):
+            parent = parent.key()
+        if key is not None:
+            self._key = key
+            self._parent = key.parent()
+            self._key_name = key.name()
+        else:
+            self._key = None
+            self._parent = parent
+            self._key_name = key_name
+            if key_name is not None:
+                self._key = Key.from_path(self.kind(), key_name,
+                                          parent=parent)
+
+        self._values = {}
+        if _from_entity is not None:
+            for name, prop in self._properties.iteritems():
+                self._values[name] = prop.make_value_from_datastore(
+                    _from_entity.get(name, prop.default_value()))
+            return
+
+        for name, prop in self._properties.iteritems():
+            if name in kwargs:
+                setattr(self, name, kwargs[name])
+            else:
+                setattr(self, name, prop.default_value())
+
+    @classmethod
+    def kind(cls):
+        return cls.__name__
+
+    @classmethod
+    def properties(cls):
+        return dict(cls._properties)
+
+    def has_key(self):
+        return self._key is not None and self._key.has_id_or_name()
+
+    def is_saved(self):
+        return self.has_key()
+
+    def key(self):
+        if not self.has_key():
+            raise NotSavedError('The entity has not been saved.')
+        return self._key
+
+    def parent_key(self):
+        return self._parent
+
+    def parent(self):
+        return get(self._parent) if self._parent else None
+
+    def put(self):
+        return put(self)
+
+    def delete(self):
+        delete(self)
+
+    def _to_entity(self):
+        return dict((name, prop.get_value_for_datastore(self))
+                    for name, prop in self._properties.iteritems())
+
+    @classmethod
+    def get(cls, keys):
+        results = get(keys)
+        for result in (results if isinstance(results, list) else [results]):
+            if result is not None and not isinstance(result, cls):
+                raise KindError('Kind %s is not a %s.' % (result.kind(),
+                                                          cls.kind()))
+        return results
+
+    @classmethod
+    def get_by_id(cls, ids, parent=None):
+        if isinstance(parent, Model):
+            parent = parent.key()
+        if isinstance(ids, (list, tuple)):
+            return cls.get([Key.from_path(cls.kind(), i, parent=parent)
+                            for i in ids])
+        return cls.get(Key.from_path(cls.kind(), ids, parent=parent))
+
+    @classmethod
+    def get_by_key_name(cls, key_names, parent=None):
+        if isinstance(parent, Model):
+            parent = parent.key()
+        if isinstance(key_names, (list, tuple)):
+            return cls.get([Key.from_path(cls.kind(), name, parent=parent)
+                            for name in key_names])
+        return cls.get(Key.from_path(cls.kind(), key_names, parent=parent))
+
+    @classmethod
+    def all(cls, keys_only=False):
+        return Query(cls, keys_only)
+
+
+def _call_hooks(call):
+    for hook in hooks:
+        hook('datastore_v3', call, None, None)
+
+def _load(key, data):
+    if key.kind() not in _models:
+        raise KindError('No model class found for kind %s.' % key.kind())
+    return _models[key.kind()](key=key, _from_entity=pickle.loads(str(data)))
+
+def _index_value(value):
+    """Returns the value stored in the property index for a property value.
+    Values of different types sort in separate ranges, like in the datastore.
+
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, Key):
+        return buffer(value._encode())
+    if isinstance(value, datetime):
+        return calendar.timegm(value.timetuple()) * 1000000 + \
+            value.microsecond
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def get(keys):
+    """Gets one or more entities by key. Missing entities are None.
+
+    """
+    _call_hooks('Get')
+    multiple = isinstance(keys, (list, tuple))
+    if not multiple:
+        keys = [keys]
+    keys = [key.key() if isinstance(key, Model) else
+            Key(key) if isinstance(key, basestring) else key for key in keys]
+
+    connection = _get_connection()
+    found = {}
+    # Stay well below the SQLite limit on query parameters.
+    for i in xrange(0, len(keys), 500):
+        chunk = [key._encode() for key in keys[i:i + 500]]
+        rows = connection.execute(
+            'SELECT key, data FROM entities WHERE key IN (%s)' %
+            ','.join('?' * len(chunk)), chunk)
+        for encoded, data in rows:
+            found[encoded] = data
+
+    results = []
+    for key in keys:
+        data = found.get(key._encode())
+        results.append(_load(key, data) if data is not None else None)
+    return results if multiple else results[0]
+
+def put(models):
+    """Stores one or more entities, assigning ids to new ones. Returns their
+    keys.
+
+    """
+    _call_hooks('Put')
+    multiple = isinstance(models, (list, tuple))
+    if not multiple:
+        models = [models]
+
+    statements = []
+    for model in models:
+        if not model.has_key():
+            model._key = Key.from_path(model.kind(), _allocate_id(),
+                                       parent=model._parent)
+        entity = model._to_entity()
+        encoded = model._key._encode()
+        statements.append(('INSERT OR REPLACE INTO entities VALUES (?, ?, ?)',
+                           (encoded, model.kind(),
+                            buffer(pickle.dumps(entity, 2)))))
+        statements.append(('DELETE FROM properties WHERE key = ?',
+                           (encoded,)))
+        for name, prop in model._properties.iteritems():
+            if not prop.indexed:
+                continue
+            values = entity[name]
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                statements.append((
+                    'INSERT INTO properties VALUES (?, ?, ?, ?)',
+                    (encoded, model.kind(), name, _index_value(value))))
+    _write(statements)
+
+    keys = [model._key for model in models]
+    return keys if multiple else keys[0]
+
+def delete(models):
+    """Deletes one or more entities, given as keys or instances.
+
+    """
+    _call_hooks('Delete')
+    if not isinstance(models, (list, tuple)):
+        models = [models]
+    statements = []
+    for model in models:
+        key = model.key() if isinstance(model, Model) else model
+        statements.append(('DELETE FROM entities WHERE key = ?',
+                           (key._encode(),)))
+        statements.append(('DELETE FROM properties WHERE key = ?',
+                           (key._encode(),)))
+    _write(statements)
+
+def run_in_transaction(function, *args, **kwargs):
+    return run_in_transaction_custom_retries(DEFAULT_TRANSACTION_RETRIES,
+                                             function, *args, **kwargs)
+
+def run_in_transaction_custom_retries(retries, function, *args, **kwargs):
+    """Runs a function in a transaction. The database is locked when the
+    transaction starts, so the function always sees the latest data. If the
+    database is locked by another writer for longer than the SQLITE_TIMEOUT
+    setting, the transaction is retried up to the specified number of times.
+
+    """
+    if _in_transaction():
+        raise BadRequestError('Nested transactions are not supported.')
+    connection = _get_connection()
+
+    stats['transactions'] += 1
+    for attempt in xrange(retries + 1):
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError, e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            stats['retries'] += 1
+            # Back off for a random time so that the retrying writers don't
+            # collide again.
+            time.sleep(random.random() * settings.SQLITE_TIMEOUT)
+            continue
+
+        _local.in_transaction = True
+        try:
+            try:
+                result = function(*args, **kwargs)
+            except Rollback:
+                connection.execute('ROLLBACK')
+                return None
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+            return result
+        finally:
+            _local.in_transaction = False
+
+    stats['failures'] += 1
+    raise TransactionFailedError(
+        'The transaction could not be committed. Please try again.')
+
+
+class Query(object):
+    """A query for entities of a kind. Supports equality and inequality
+    filters, an ancestor and sort orders.
+
+    """
+    _OPERATORS = ('<=', '>=', '<', '>', '=')
+
+    def __init__(self, model_class, keys_only=False):
+        self._model_class = model_class
+        self._keys_only = keys_only
+        self._filters = []
+        self._orders = []
+        self._ancestor = None
+
+    def filter(self, property_operator, value):
+        parts = property_operator.split()
+        if len(parts) == 1:
+            name, operator = parts[0], '='
+        elif len(parts) == 2 and parts[1] in self._OPERATORS:
+            name, operator = parts
+        else:
+            raise BadArgumentError('Invalid filter: %s' % property_operator)
+        if isinstance(value, Model):
+            value = value.key()
+        self._filters.append((name, operator, value))
+        return self
+
+    def ancestor(self, ancestor):
+        if isinstance(ancestor, Model):
+            ancestor = ancestor.key()
+        self._ancestor = ancestor
+        return self
+
+    def order(self, prop):
+        if prop.startswith('-'):
+            self._orders.append((prop[1:], 'DESC'))
+        else:
+            self._orders.append((prop, 'ASC'))
+        return self
+
+    def _build(self, limit, offset):
+        kind = self._model_class.kind()
+        joins = []
+        where = ['e.kind = ?']
+        parameters = []
+        where_parameters = [kind]
+
+        for i, (name, operator, value) in enumerate(self._filters):
+            if name == '__key__':
+                where.append('e.key %s ?' % operator)
+                where_parameters.append(value._encode())
+                continue
+            alias = 'f%d' % i
+            joins.append('JOIN properties %s ON %s.key = e.key AND '
+                         '%s.kind = ? AND %s.name = ? AND %s.value %s ?' % (
+                             alias, alias, alias, alias, alias, operator))
+            parameters.extend([kind, name, _index_value(value)])
+
+        if self._ancestor:
+            encoded = self._ancestor._encode()
+            # Descendants have keys that start with the ancestor key and a
+            # slash, and "0" is the character right after the slash.
+            where.append('(e.key = ? OR (e.key > ? AND e.key < ?))')
+            where_parameters.extend([encoded, encoded + '/', encoded + '0'])
+
+        order_by = []
+        for i, (name, direction) in enumerate(self._orders):
+            if name == '__key__':
+                order_by.append('e.key %s' % direction)
+                continue
+            alias = 'o%d' % i
+            joins.append('JOIN properties %s ON %s.key = e.key AND '
+                         '%s.kind = ? AND %s.name = ?' % (
+                             alias, alias, alias, alias))
+            parameters.extend([kind, name])
+            # List properties sort by their smallest value when ascending
+            # and their largest value when descending.
+            order_by.append('%s(%s.value) %s' % (
+                'MIN' if direction == 'ASC' else 'MAX', alias, direction))
+        order_by.append('e.key ASC')
+
+        sql = ('SELECT e.key, e.data FROM entities e %s WHERE %s '
+               'GROUP BY e.key ORDER BY %s' % (
+                   ' '.join(joins), ' AND '.join(where), ', '.join(order_by)))
+        if limit is not None:
+            sql += ' LIMIT %d OFFSET %d' % (limit, offset)
+        elif offset:
+            sql += ' LIMIT -1 OFFSET %d' % offset
+        return sql, parameters + where_parameters
+
+    def fetch(self, limit, offset=0):
+        _call_hooks('RunQuery')
+        sql, parameters = self._build(limit, offset)
+        rows = _get_connection().execute(sql, parameters).fetchall()
+        if self._keys_only:
+            return [Key(encoded) for encoded, data in rows]
+        return [_load(Key(encoded), data) for encoded, data in rows]
+
+    def get(self):
+        results = self.fetch(1)
+        return results[0] if results else None
+
+    def count(self, limit=None):
+        return len(self.fetch(limit))
+
+    def __iter__(self):
+        return iter(self.fetch(None))
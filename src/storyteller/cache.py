@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Helpers for working with the values that the controller keeps in memcache.
+
+Values are stored together with the time at which they should be rebuilt.
+When a value is due to be rebuilt (or is missing altogether), only one request
+gets a lease to rebuild it; other requests are served the old value, or wait
+for the rebuilt value if there is no old value.
+
+Cache keys are versioned by the generations of the stories that the cached
+value depends on. Incrementing the generation of a story makes every value
+that depends on it unreachable, and the unreachable values are left for
+memcache to evict.
+
+In front of memcache there is a small in-process cache, so that the values of
+the most read stories never leave the instance. Its entries only live for a
+few seconds, which bounds how long an instance can go without seeing a write
+made through another instance.
+
+"""
+
+import cPickle as pickle
+import hashlib
+import logging
+import threading
+import time
+
+from storyteller import metrics, settings
+from storyteller.backends import memcache
+
+# The number of seconds to wait between checks for a value that another
+# request is rebuilding.
+WAIT_INTERVAL = 0.05
+
+# Counters for the requests handled by this instance. "coalesced" counts the
+# requests that relied on another request rebuilding a value instead of
+# rebuilding it themselves.
+stats = {'local_hits': 0, 'local_misses': 0,
+         'memcache_hits': 0, 'memcache_misses': 0,
+         'rebuilds': 0, 'coalesced': 0}
+
+
+class LocalCache(object):
+    """An in-process least recently used cache, limited to a number of bytes.
+    Entries may also expire after a number of seconds.
+
+    Values are stored pickled, both to know their size and so that every
+    caller gets its own copy to modify. The cache may be used by several
+    threads at once.
+
+    """
+    # Indexes into the lists that make up the linked list of entries.
+    PREV, NEXT, KEY, DATA, EXPIRES = range(5)
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = {}
+        # Guards the entries, the linked list and the size.
+        self._lock = threading.Lock()
+        # The linked list is circular, with the most recently used entry right
+        # after the root and the least recently used entry right before it.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, '', None]
+
+    def _unlink(self, entry):
+        entry[self.PREV][self.NEXT] = entry[self.NEXT]
+        entry[self.NEXT][self.PREV] = entry[self.PREV]
+
+    def _link(self, entry):
+        first = self._root[self.NEXT]
+        entry[self.PREV] = self._root
+        entry[self.NEXT] = first
+        first[self.PREV] = entry
+        self._root[self.NEXT] = entry
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._unlink(entry)
+            self.size -= len(entry[self.DATA])
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.size = 0
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, '', None]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._delete(key)
+        finally:
+            self._lock.release()
+
+    def has(self, key):
+        """Returns whether there is a value for the specified key that has not
+        expired.
+
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            return bool(entry) and (entry[self.EXPIRES] is None or
+                                    entry[self.EXPIRES] > time.time())
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        """Returns the value for the specified key, or None if it is not
+        cached or has expired.
+
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if entry[self.EXPIRES] is not None and \
+                    entry[self.EXPIRES] <= time.time():
+                self._delete(key)
+                return None
+
+            self._unlink(entry)
+            self._link(entry)
+            data = entry[self.DATA]
+        finally:
+            self._lock.release()
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        """Caches a value, evicting the least recently used entries if needed.
+        Values larger than a tenth of the cache are not cached.
+
+        """
+        data = pickle.dumps(value, 2)
+        self._lock.acquire()
+        try:
+            self._delete(key)
+            if len(data) > self.max_bytes / 10:
+                return
+
+            entry = [None, None, key, data,
+                     time.time() + ttl if ttl is not None else None]
+            self._link(entry)
+            self._entries[key] = entry
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                self._delete(self._root[self.PREV][self.KEY])
+        finally:
+            self._lock.release()
+
+local = LocalCache(settings.LOCAL_CACHE_SIZE)
+
+
+def _get_generation_key(story_id):
+    # Besides story ids, generations are kept for a few other things that
+    # cached values depend on, identified by strings (see the controller).
+    return 'generation:%s' % story_id
+
+def _get_initial_generation():
+    # Generations start at the current time in microseconds so that a
+    # generation that was evicted from memcache never comes back with a value
+    # that has been used before.
+    return int(time.time() * 1000000)
+
+def _get_lease_key(key):
+    return 'lease:%s' % key
+
+def _rebuild(key, build):
+    stats['rebuilds'] += 1
+    try:
+        value = build()
+        memcache.set(key, (value, time.time() + settings.CACHE_TTL))
+        local.set(key, value, settings.LOCAL_CACHE_TTL)
+        return value
+    finally:
+        memcache.delete(_get_lease_key(key))
+
+def get(key, build):
+    """Gets a cached value, calling build() to get a new value if it is
+    missing or due to be rebuilt. Only one request at a time will call build()
+    for a key.
+
+    """
+    value = local.get(key)
+    if value is not None:
+        stats['local_hits'] += 1
+        metrics.count_cache(key, 'local_hits')
+        return value
+    stats['local_misses'] += 1
+
+    entry = memcache.get(key)
+    if entry is not None:
+        value, rebuild_at = entry
+        ttl = min(rebuild_at - time.time(), settings.LOCAL_CACHE_TTL)
+        if ttl > 0:
+            stats['memcache_hits'] += 1
+            metrics.count_cache(key, 'memcache_hits')
+            local.set(key, value, ttl)
+            return value
+        if not memcache.add(_get_lease_key(key), 1,
+                            time=settings.CACHE_LEASE_TIME):
+            # Another request is rebuilding the value; use the old one.
+            stats['coalesced'] += 1
+            metrics.count_cache(key, 'memcache_hits')
+            return value
+        metrics.count_cache(key, 'misses')
+        return _rebuild(key, build)
+
+    stats['memcache_misses'] += 1
+    metrics.count_cache(key, 'misses')
+    if memcache.add(_get_lease_key(key), 1, time=settings.CACHE_LEASE_TIME):
+        return _rebuild(key, build)
+
+    # Another request is rebuilding the value. Wait for it for as long as the
+    # lease lasts.
+    stats['coalesced'] += 1
+    deadline = time.time() + settings.CACHE_LEASE_TIME
+    while time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        entry = memcache.get(key)
+        if entry is not None:
+            return entry[0]
+        # If the lease was given up without a value, the rebuild failed, so
+        # take over instead of waiting for a value that will never come.
+        if memcache.add(_get_lease_key(key), 1,
+                        time=settings.CACHE_LEASE_TIME):
+            return _rebuild(key, build)
+
+    logging.warning('Timed out waiting for a rebuild of %s.', key)
+    return build()
+
+def prefetch(keys):
+    """Loads the values for several keys from memcache into the in-process
+    cache with a single round trip, so that get() calls for them don't have to
+    leave the instance. Returns the keys that have no value or have values due
+    to be rebuilt.
+
+    """
+    keys = [key for key in keys if not local.has(key)]
+    if not keys:
+        return []
+
+    entries = memcache.get_multi(keys)
+    missing = []
+    for key in keys:
+        value, rebuild_at = entries.get(key, (None, 0))
+        ttl = min(rebuild_at - time.time(), settings.LOCAL_CACHE_TTL)
+        if ttl > 0:
+            local.set(key, value, ttl)
+        else:
+            missing.append(key)
+    return missing
+
+
+def get_generations(story_ids):
+    """Returns a dict of the specified story ids mapped to the current
+    generations of the stories.
+
+    """
+    generations = {}
+    keys = {}
+    for story_id in story_ids:
+        key = _get_generation_key(story_id)
+        generation = local.get(key)
+        if generation is None:
+            keys[key] = story_id
+        else:
+            generations[story_id] = generation
+    if not keys:
+        return generations
+
+    values = memcache.get_multi(keys.keys())
+    missing = [k for k in keys if k not in values]
+    if missing:
+        memcache.add_multi(dict((k, _get_initial_generation())
+                                for k in missing))
+        values.update(memcache.get_multi(missing))
+
+    for key, story_id in keys.iteritems():
+        generations[story_id] = values.get(key, 0)
+        if key in values:
+            local.set(key, values[key], settings.LOCAL_GENERATION_TTL)
+    return generations
+
+def increment_generations(story_ids):
+    """Increments the generations of the specified stories, which invalidates
+    every cached value that depends on them. Returns a dict of the story ids
+    mapped to their new generations. Stories whose generation could not be
+    incremented are left out.
+
+    """
+    keys = dict((_get_generation_key(story_id), story_id)
+                for story_id in story_ids)
+    values = memcache.offset_multi(dict((key, 1) for key in keys),
+                                   initial_value=_get_initial_generation())
+
+    generations = {}
+    for key, value in values.iteritems():
+        if value is None:
+            local.delete(key)
+        else:
+            # Make the new generation visible to this instance right away.
+            local.set(key, value, settings.LOCAL_GENERATION_TTL)
+            generations[keys[key]] = value
+    return generations
+
+def get_versioned_key(key, generations):
+    """Returns the specified key versioned by a list of generations.
+
+    """
+    version = '.'.join(str(generation) for generation in generations)
+    if len(key) + len(version) > 200:
+        version = hashlib.md5(version).hexdigest()
+    return '%s@%s' % (key, version)
+
+def advance_multi(updaters):
+    """Copies cached values to the keys of a new version, updating them on the
+    way. Takes a dict of the current keys mapped to tuples of the new key and
+    a function that takes the cached value and returns the updated value, or
+    None if the value could not be updated.
+
+    Values are only added under the new keys, so a value that has already been
+    rebuilt under a new key is never overwritten. Values that are not cached
+    or could not be updated are left for the next reader to rebuild.
+
+    """
+    if not updaters:
+        return
+
+    updated = {}
+    for key, (value, rebuild_at) in memcache.get_multi(
+            updaters.keys()).iteritems():
+        new_key, updater = updaters[key]
+        value = updater(value)
+        if value is not None:
+            updated[new_key] = (value, rebuild_at)
+
+    if updated:
+        memcache.add_multi(updated)
@@ -25,16 +25,228 @@ views) and the back-end (models and data logic).
 
 """
 
+import base64
 from datetime import datetime, timedelta
+import hashlib
+import logging
 import os
+import random
+import time
 
-from google.appengine.api import memcache
+from django.utils import simplejson
+from google.appengine.api import users
 
 import storyteller
-from storyteller import model, settings, utils
-from storyteller.utils import public
+from storyteller import cache, metrics, model, settings, utils
+from storyteller.backends import db, memcache, taskqueue
+from storyteller.utils import public, versioned
 
 
+def _get_ancestries(story_ids):
+    """Returns a dict of story ids mapped to the branch indexes of the stories
+    (see Story.get_ancestry). Since they never change, they are cached
+    indefinitely. Stories that do not exist are left out.
+
+    All stories are looked up together, so this takes at most one round trip
+    to memcache and one to the datastore.
+
+    """
+    ancestries = {}
+    keys = {}
+    for story_id in story_ids:
+        cache_key = 'ancestry:%d' % story_id
+        ancestry = cache.local.get(cache_key)
+        if ancestry is None:
+            keys[cache_key] = story_id
+        else:
+            metrics.count_cache(cache_key, 'local_hits')
+            ancestries[story_id] = ancestry
+    if not keys:
+        return ancestries
+
+    cached = memcache.get_multi(keys.keys())
+    missing = [key for key in keys if key not in cached]
+    metrics.count('cache.ancestry.memcache_hits', len(keys) - len(missing))
+    metrics.count('cache.ancestry.misses', len(missing))
+    if missing:
+        stories = model.Story.get_by_id([keys[key] for key in missing])
+        fetched = dict((key, story.get_ancestry())
+                       for key, story in zip(missing, stories) if story)
+        memcache.set_multi(fetched)
+        cached.update(fetched)
+
+    for cache_key, ancestry in cached.iteritems():
+        cache.local.set(cache_key, ancestry)
+        ancestries[keys[cache_key]] = ancestry
+    return ancestries
+
+def _get_ancestry(story):
+    """Returns the branch index of a story (see Story.get_ancestry).
+
+    """
+    if not isinstance(story, (int, long)):
+        return story.get_ancestry()
+
+    ancestries = _get_ancestries([story])
+    if story not in ancestries:
+        raise storyteller.StoryNotFoundError('Story not found.')
+    return ancestries[story]
+
+def get_story_version(story_id):
+    """Returns a string that changes whenever the data of a story changes,
+    including the paragraphs it inherits from the stories it was branched off
+    of. This is cheap to get since it only depends on cached values; no
+    paragraphs are read.
+
+    """
+    story_ids = [story_id] + [i for i in set(_get_ancestry(story_id)[1])
+                              if i != story_id]
+    generations = cache.get_generations(story_ids)
+    return '.'.join([str(generations[i]) for i in story_ids])
+
+def _get_root_id(story_id):
+    """Returns the id of the story that the branch tree of a story starts
+    with.
+
+    """
+    branch_story_ids = _get_ancestry(story_id)[1]
+    if branch_story_ids:
+        return branch_story_ids[0]
+    return story_id
+
+def _get_tree_id(root_id):
+    # The id that the generation of a branch tree is kept under.
+    return 'tree-%d' % root_id
+
+def _get_term_ids(words):
+    # The ids that the generations of the search results for words are kept
+    # under.
+    return ['term-%s' % word.encode('utf-8') for word in words]
+
+def _get_query_words(query):
+    if not isinstance(query, basestring):
+        raise TypeError('Query must be a string.')
+    words = model.get_words(query)[:settings.SEARCH_MAX_TERMS]
+    if not words:
+        raise ValueError('The query has no words to search for.')
+    return words
+
+def _get_search_page(query, after, limit):
+    """Checks the arguments of search, and returns the words of the query and
+    the offset and number of the results that are asked for.
+
+    """
+    words = _get_query_words(query)
+    if after is None:
+        offset = 0
+    elif isinstance(after, basestring):
+        offset = _decode_search_cursor(words, after)
+    else:
+        raise TypeError('After must be a cursor.')
+    if limit is None:
+        limit = settings.SEARCH_PAGE_SIZE
+    if not isinstance(limit, (int, long)):
+        raise TypeError('Limit must be an integer.')
+    if not 1 <= limit <= settings.SEARCH_MAX_LIMIT:
+        raise ValueError('Limit must be between 1 and %d.' %
+                         settings.SEARCH_MAX_LIMIT)
+    return words, offset, limit
+
+def _get_search_results(words):
+    """Returns the story ids and numbers of the paragraphs that contain the
+    words, best first. Cached until a paragraph with any of the words is
+    added.
+
+    """
+    term_ids = _get_term_ids(words)
+    generations = cache.get_generations(term_ids)
+    query_hash = hashlib.md5(' '.join(words).encode('utf-8')).hexdigest()
+
+    def build():
+        return [(key.parent().id(), int(key.name())) for key in
+                model.search(words, settings.SEARCH_CANDIDATES)]
+
+    return cache.get(cache.get_versioned_key(
+        'search:%s' % query_hash, [generations[i] for i in term_ids]), build)
+
+def _get_search_generations(words, results):
+    # A page of search results changes when a paragraph with any of the words
+    # is added, and when the story of a paragraph on it changes, since the
+    # records hold the branch counts of the paragraphs.
+    ids = _get_term_ids(words) + sorted(set(story_id
+                                            for story_id, number in results))
+    generations = cache.get_generations(ids)
+    return [generations[i] for i in ids]
+
+def get_search_version(query, after=None, limit=None):
+    """Returns a string that changes whenever a page of the results of a
+    search query changes: when a paragraph with any of the words of the query
+    is added, or when the story of a paragraph on the page changes.
+
+    """
+    words, offset, limit = _get_search_page(query, after, limit)
+    results = _get_search_results(words)[offset:offset + limit]
+    return '.'.join([str(generation) for generation in
+                     _get_search_generations(words, results)])
+
+def get_feeds_version():
+    """Returns a string that changes whenever the feeds are rebuilt.
+
+    """
+    return str(cache.get_generations(['feeds'])['feeds'])
+
+def _get_feed_records(name):
+    """Returns the records of the stories in a feed. Feeds are cached until
+    they are rebuilt.
+
+    """
+    key = cache.get_versioned_key('feed:%s' % name,
+                                  [cache.get_generations(['feeds'])['feeds']])
+    return cache.get(key, lambda: model.get_feed(name))
+
+def get_tree_version(story_id):
+    """Returns a string that changes whenever a story is added to, or
+    continued in, the branch tree that a story belongs to.
+
+    """
+    tree_id = _get_tree_id(_get_root_id(story_id))
+    return str(cache.get_generations([tree_id])[tree_id])
+
+def _get_page_story_ids(story_id, ancestry, page):
+    """Returns the ids of the stories that the paragraphs on a page of a story
+    depend on.
+
+    """
+    start, end = model.get_page_range(page)
+    story_ids = [story_id]
+    for owner_id, first, last in model.get_owners(ancestry, story_id, start,
+                                                  end):
+        if owner_id != story_id:
+            story_ids.append(owner_id)
+    return story_ids
+
+def _get_page_key(story_id, ancestry, page, generations=None):
+    story_ids = _get_page_story_ids(story_id, ancestry, page)
+    if generations is None:
+        generations = cache.get_generations(story_ids)
+    return cache.get_versioned_key('paragraphs:%d:%d' % (story_id, page),
+                                   [generations[i] for i in story_ids])
+
+def _get_paragraph_key(story_id, number, generations=None):
+    if generations is None:
+        generations = cache.get_generations([story_id])
+    return cache.get_versioned_key('paragraph:%d:%d' % (story_id, number),
+                                   [generations[story_id]])
+
+def _get_story_key(story_id, ancestry, generations=None):
+    # Since story data is returned with the first page, it depends on the
+    # same stories as the first page.
+    story_ids = _get_page_story_ids(story_id, ancestry, 1)
+    if generations is None:
+        generations = cache.get_generations(story_ids)
+    return cache.get_versioned_key('story:%d' % story_id,
+                                   [generations[i] for i in story_ids])
+
 def _get_paragraphs(story, page=None):
     if page < 1:
         page = 1
@@ -44,25 +256,304 @@ def _get_paragraphs(story, page=None):
     else:
         story_id = story.key().id()
 
-    cache_key = 'paragraphs:%d:%d' % (story_id, page)
-    data = memcache.get(cache_key)
-    if data:
+    def build():
+        instance = model.get_instance(story, model.Story)
+        if not instance:
+            raise storyteller.StoryNotFoundError('Story not found.')
+        return utils.records_to_json(model.add_pending_branches(
+            model.PageSnapshot.get_page(instance, page)))
+
+    return utils.JsonText(cache.get(
+        _get_page_key(story_id, _get_ancestry(story), page), build))
+
+def _encode_cursor(story_id, number):
+    return base64.urlsafe_b64encode('%d:%d' % (story_id, number))
+
+def _decode_cursor(story_id, cursor):
+    """Returns the number of the paragraph that a cursor points after.
+
+    """
+    try:
+        cursor_story_id, number = [int(value) for value in
+                                   base64.urlsafe_b64decode(str(cursor))
+                                   .split(':')]
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if cursor_story_id != story_id:
+        raise ValueError('The cursor belongs to another story.')
+    return number
+
+def _encode_branch_cursor(story_id, number, order, branch):
+    """Returns a cursor for the branches of a paragraph that follow the
+    specified branch, which is a Paragraph instance, in the specified order.
+
+    """
+    value = getattr(branch, order)
+    if isinstance(value, float):
+        # repr() keeps every digit, so that equal values stay equal.
+        value = repr(value)
+    else:
+        value = '%d' % value
+    return base64.urlsafe_b64encode('%d:%d:%s:%s:%d:%d' % (
+        story_id, number, order, value, branch.key().parent().id(),
+        branch.number))
+
+def _decode_branch_cursor(story_id, number, order, cursor):
+    """Returns the (value, key) tuple that a cursor for the branches of a
+    paragraph points after (see Paragraph.get_branches).
+
+    """
+    try:
+        cursor_story_id, cursor_number, cursor_order, value, \
+            branch_story_id, branch_number = \
+            base64.urlsafe_b64decode(str(cursor)).split(':')
+        cursor_story_id, cursor_number, branch_story_id, branch_number = [
+            int(v) for v in (cursor_story_id, cursor_number, branch_story_id,
+                             branch_number)]
+        if cursor_order == 'score':
+            value = float(value)
+        else:
+            value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if (cursor_story_id, cursor_number) != (story_id, number):
+        raise ValueError('The cursor belongs to another paragraph.')
+    if cursor_order != order:
+        raise ValueError('The cursor belongs to another order.')
+    return value, model.get_key(
+        str(branch_number), 'Paragraph',
+        parent=model.get_key(branch_story_id, 'Story'))
+
+def _encode_search_cursor(words, offset):
+    digest = hashlib.md5(' '.join(words).encode('utf-8')).hexdigest()[:8]
+    return base64.urlsafe_b64encode('%s:%d' % (digest, offset))
+
+def _decode_search_cursor(words, cursor):
+    """Returns the number of search results that a cursor points after.
+
+    """
+    try:
+        digest, offset = base64.urlsafe_b64decode(str(cursor)).split(':')
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if _encode_search_cursor(words, offset) != cursor:
+        raise ValueError('The cursor belongs to another query.')
+    return offset
+
+def _encode_feed_cursor(name, offset):
+    return base64.urlsafe_b64encode('%s:%d' % (name, offset))
+
+def _decode_feed_cursor(name, cursor):
+    """Returns the number of stories in a feed that a cursor points after.
+
+    """
+    try:
+        cursor_name, offset = base64.urlsafe_b64decode(str(cursor)).split(':')
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if cursor_name != name:
+        raise ValueError('The cursor belongs to another feed.')
+    return offset
+
+def _get_voter_id(handler):
+    """Returns the id of the user making a request, for telling voters apart.
+    Signed in users are identified by their account. For other users, the id
+    is kept in a cookie; users who don't have one are given a new one, and the
+    number of votes from their IP address is limited (see
+    _limit_anonymous_votes), since the cookie is easy to get rid of.
+
+    """
+    user = users.get_current_user()
+    if user:
+        # Voter ids are stored as 32-bit integers.
+        return int(hashlib.md5('user:%s' % user.user_id()).hexdigest()[:8],
+                   16) or 1
+
+    _limit_anonymous_votes(handler)
+    try:
+        voter_id = int(handler.request.cookies.get('voter', ''))
+    except ValueError:
+        voter_id = None
+    if not voter_id or not 0 < voter_id < 2 ** 32:
+        voter_id = random.randint(1, 2 ** 32 - 1)
+        utils.set_cookie(handler, 'voter', voter_id,
+                         expires=datetime.now() + timedelta(days=3650))
+    return voter_id
+
+def _limit_anonymous_votes(handler):
+    """Counts a vote from a user who is not signed in against the IP address
+    of the request, and raises VotesNotPossibleError if the address has made
+    more than ANONYMOUS_VOTES_PER_HOUR such votes in the current hour.
+
+    """
+    hour = int(time.time()) / 3600
+    count = memcache.incr('anonymous_votes:%s:%d' % (
+        handler.request.remote_addr, hour), initial_value=0)
+    if count > settings.ANONYMOUS_VOTES_PER_HOUR:
+        raise storyteller.VotesNotPossibleError(
+            'Too many votes from your address; sign in to vote more.')
+
+def _warm_page(story_id, number):
+    """Makes sure that the page after the specified paragraph is cached, by
+    building it in the task queue if it isn't. Also loads it into the local
+    cache if it is.
+
+    """
+    page = model.get_page_number(number + 1)
+    key = _get_page_key(story_id, _get_ancestry(story_id), page)
+    if not cache.prefetch([key]):
+        return
+    try:
+        # The name makes sure that each version of a page is only built
+        # once.
+        taskqueue.add(
+            name='warm-paragraphs-%d-%d-%s' % (story_id, page,
+                                               hashlib.md5(key).hexdigest()),
+            url='/tasks/warm_paragraphs',
+            params={'story_id': story_id, 'page': page})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def _patch_records(records, add=None, bump=None):
+    """Updates a list of cached paragraph records to reflect a new paragraph.
+    The add record is appended to the list and the branch count of the record
+    identified by the (story id, number) tuple bump is incremented.
+
+    Returns None if the records cannot be patched.
+
+    """
+    if bump:
+        for record in records:
+            if (record['story_id'], record['number']) == bump:
+                record['num_branches'] += 1
+                break
+    if add:
+        if not records or records[-1]['number'] != add['number'] - 1:
+            return None
+        records.append(add)
+    return records
+
+def _update_caches(story_id, paragraph_number, base_paragraph, story,
+                   paragraph, branched):
+    """Updates the cached data after a paragraph has been added. Takes the
+    arguments of add_paragraph and the results of Story.add_paragraph.
+
+    """
+    # Keep in mind in the code below that story_id refers to the original story
+    # and story.length could be the length of a new story (and thus very
+    # different from the length of the original story).
+    record = paragraph.get_record()
+    page = model.get_page_number(paragraph.number)
+    if base_paragraph:
+        # The base paragraph always belongs to the original story.
+        base = (story_id, paragraph_number)
+        base_page = model.get_page_number(paragraph_number)
+        parent_key = model.Paragraph.follows.get_value_for_datastore(
+            base_paragraph)
+    else:
+        base = None
+        base_page = None
+        parent_key = None
+
+    # Invalidate everything that depends on the original story, including the
+    # pages that branches of it inherit. Since the branch count of the base
+    # paragraph is cached in the list of branches of its parent, the story of
+    # the parent is invalidated as well.
+    invalidated = [story_id]
+    if parent_key and parent_key.parent().id() != story_id:
+        invalidated.append(parent_key.parent().id())
+    # The branch tree changes with every paragraph, since it holds the length
+    # of each story, and so do the search results for the words of the
+    # paragraph.
+    others = [_get_tree_id(_get_root_id(story_id))] + _get_term_ids(
+        model.get_words(paragraph.text))
+    new_generations = cache.increment_generations(invalidated + others)
+    if len(new_generations) < len(invalidated) + len(others):
+        # The generations are not available, so nothing is cached.
+        return
+    for i in others:
+        del new_generations[i]
+
+    # Carry the cached data of the original story over to the new generation,
+    # so that readers of a story that is being written to keep getting cache
+    # hits.
+    ancestry = _get_ancestry(story_id)
+    story_ids = set(_get_page_story_ids(story_id, ancestry, 1))
+    for number in (page, base_page):
+        if number:
+            story_ids.update(_get_page_story_ids(story_id, ancestry, number))
+    story_ids.difference_update(invalidated)
+    generations = cache.get_generations(story_ids)
+    old_generations = dict(generations)
+    for i, generation in new_generations.iteritems():
+        old_generations[i] = generation - 1
+    generations.update(new_generations)
+
+    updaters = {}
+    def advance(get_key, updater, serialize):
+        # The cached values are JSON, so they are patched as data and then
+        # serialized again.
+        def update(text):
+            data = updater(simplejson.loads(text))
+            if data is None:
+                return None
+            return serialize(data)
+        updaters[get_key(old_generations)] = (get_key(generations), update)
+
+    if not branched:
+        advance(lambda g: _get_page_key(story_id, ancestry, page, g),
+                lambda records: _patch_records(
+                    records, add=record,
+                    bump=base if base_page == page else None),
+                utils.records_to_json)
+    if base and (branched or base_page != page):
+        advance(lambda g: _get_page_key(story_id, ancestry, base_page, g),
+                lambda records: _patch_records(records, bump=base),
+                utils.records_to_json)
+
+    def patch_story(data):
+        if not branched:
+            data['length'] = story.length
+        data['paragraphs'] = _patch_records(
+            data['paragraphs'],
+            add=record if not branched and page == 1 else None,
+            bump=base if base_page == 1 else None)
+        if data['paragraphs'] is None:
+            return None
         return data
+    advance(lambda g: _get_story_key(story_id, ancestry, g), patch_story,
+            utils.story_to_json)
 
-    # Calculate the numbers of the first and last paragraphs to get.
-    start = (page - 1) * settings.PAGE_SIZE + 1
-    end = start + settings.PAGE_SIZE - 1
+    if base:
+        def patch_base(data):
+            if data.get('branches_cursor') or \
+                    len(data['branches']) >= settings.BRANCHES_PAGE_SIZE:
+                # The list of branches is cut off, or would be by the new
+                # paragraph, so it is left to be rebuilt with a cursor. New
+                # paragraphs have no branches, so if the list is whole and
+                # has room, the new paragraph goes last.
+                return None
+            data['branches'].append(record)
+            return data
+        advance(lambda g: _get_paragraph_key(story_id, paragraph_number, g),
+                patch_base, utils.paragraph_to_json)
 
-    data = [{'story_id': p.key().parent().id(), 'number': p.number,
-             'created': p.created, 'text': p.text,
-             'num_branches': p.num_branches}
-            for p in model.Paragraph.get_range(story, start, end)]
-    memcache.set(cache_key, data)
+        if parent_key:
+            # The first paragraph in a story won't have a parent.
+            def patch_parent(data):
+                data['branches'] = _patch_records(data['branches'], bump=base)
+                return data
+            advance(lambda g: _get_paragraph_key(parent_key.parent().id(),
+                                                 int(parent_key.name()), g),
+                    patch_parent, utils.paragraph_to_json)
 
-    return data
+    cache.advance_multi(updaters)
 
 
 @public
+@metrics.timed('controller')
 def add_paragraph(handler, story_id, paragraph_number, text):
     """Adds a new paragraph after a certain paragraph. Note that this might
     branch the story and return a different story id than the one that was
@@ -72,38 +563,243 @@ def add_paragraph(handler, story_id, paragraph_number, text):
     base_paragraph, story, paragraph, branched = model.Story.add_paragraph(
         story_id, paragraph_number, text)
 
-    # Keep in mind in the code below that story_id refers to the original story
-    # and story.length could be the length of a new story (and thus very
-    # different from the length of the original story).
-    page = (story.length - 1) / settings.PAGE_SIZE + 1
-
-    keys = ['paragraph:%d:%d' % (story_id, paragraph_number),
-            'paragraphs:%d:%d' % (story_id, page)]
-    if page == 1:
-        # Since story data is returned with the first page, the story cache
-        # needs to be purged.
-        keys.append('story:%d' % story_id)
-    elif story.length % settings.PAGE_SIZE == 1:
-        # This is the first paragraph of a page, meaning that the previous page
-        # needs to be purged as well (so that the new num_branches value can be
-        # returned).
-        keys.append('paragraphs:%d:%d' % (story_id, page - 1))
-
-    if branched:
-        # Since the branch count is cached in the list of branches, the cached
-        # parent of the base paragraph will need to be purged.
-        parent_key = base_paragraph._entity['follows']
-        if parent_key:
-            # The first paragraph in a story won't have a parent.
-            keys.append('paragraph:%d:%s' % (parent_key.parent().id(),
-                                             parent_key.name()))
-
-    memcache.delete_multi(keys)
+    _update_caches(story_id, paragraph_number, base_paragraph, story,
+                   paragraph, branched)
 
     return {'story_id': story.key().id(), 'paragraph_number': paragraph.number,
             'branched': branched}
 
 @public
+@metrics.timed('controller')
+def batch(handler, calls):
+    """Runs several public functions in a single request. Takes a list of
+    [function name, arguments] pairs, where the arguments are a dict, and
+    returns a list with a result for each call in the same format as the API
+    handler uses for single calls.
+
+    The stories and paragraphs read by the calls are fetched together, so
+    that the whole batch costs a round trip to each of memcache and the
+    datastore rather than one per call.
+
+    """
+    if not isinstance(calls, list):
+        raise TypeError('Calls must be a list.')
+    if len(calls) > settings.BATCH_MAX_CALLS:
+        raise ValueError('Too many calls; the maximum is %d.' %
+                         settings.BATCH_MAX_CALLS)
+
+    parsed = []
+    for call in calls:
+        if not isinstance(call, list) or len(call) != 2 or \
+                not isinstance(call[0], basestring) or \
+                not isinstance(call[1], dict):
+            raise TypeError('Each call must be a [name, arguments] pair.')
+        name, kwargs = call
+        # Keyword argument names must be byte strings.
+        parsed.append((str(name),
+                       dict((str(k), v) for k, v in kwargs.iteritems())))
+
+    prefetched = _prefetch(parsed)
+
+    results = []
+    for name, kwargs in parsed:
+        try:
+            func = globals().get(name)
+            if name == 'batch' or not getattr(func, '__public', False):
+                raise storyteller.NotFoundError(
+                    'There is no public function named %s.' % name)
+
+            prefetch = prefetched.get(name, {}).get(
+                tuple(sorted(kwargs.items())))
+            if prefetch:
+                data = prefetch()
+            else:
+                data = func(handler, **kwargs)
+
+            if isinstance(data, utils.JsonText):
+                results.append('{"status":"success","response":%s}' % data)
+            else:
+                results.append(utils.to_json({'status': 'success',
+                                              'response': data}))
+        except BaseException, e:
+            logging.exception('Batch call error:')
+            results.append(utils.to_json({'status': 'error',
+                                          'response': str(e),
+                                          'module': type(e).__module__,
+                                          'type': type(e).__name__}))
+
+    return utils.JsonText('[%s]' % ','.join(results))
+
+def _prefetch(calls):
+    """Fetches the data for the get_story and get_paragraph calls in a list of
+    calls, up to the first call of any other function (which could change the
+    data). Cached values are loaded into the in-process cache with a single
+    memcache round trip, and the stories and paragraphs that are not cached
+    are fetched with a single datastore get.
+
+    Returns a dict of function names mapped to dicts of sorted argument tuples
+    mapped to functions that return the result of the call.
+
+    """
+    story_ids = []
+    paragraphs = []
+    for name, kwargs in calls:
+        if name == 'get_story' and kwargs.keys() == ['id']:
+            if isinstance(kwargs['id'], (int, long)) and kwargs['id']:
+                story_ids.append(kwargs['id'])
+        elif name == 'get_paragraph' and \
+                sorted(kwargs.keys()) == ['number', 'story_id']:
+            if isinstance(kwargs['story_id'], (int, long)) and \
+                    isinstance(kwargs['number'], (int, long)):
+                paragraphs.append((kwargs['story_id'], kwargs['number']))
+        else:
+            break
+    if not story_ids and not paragraphs:
+        return {}
+
+    ancestries = _get_ancestries(story_ids)
+    story_ids = [i for i in story_ids if i in ancestries]
+
+    generation_ids = set(story_id for story_id, number in paragraphs)
+    for story_id in story_ids:
+        generation_ids.update(
+            _get_page_story_ids(story_id, ancestries[story_id], 1))
+    generations = cache.get_generations(generation_ids)
+
+    story_keys = dict(
+        (_get_story_key(i, ancestries[i], generations), i) for i in story_ids)
+    paragraph_keys = dict(
+        (_get_paragraph_key(story_id, number, generations), (story_id, number))
+        for story_id, number in paragraphs)
+    missing = cache.prefetch(story_keys.keys() + paragraph_keys.keys())
+
+    # Get the entities needed to rebuild the values that were not cached.
+    entity_keys = []
+    for key in missing:
+        if key in story_keys:
+            entity_keys.append(model.get_key(story_keys[key], 'Story'))
+        else:
+            story_id, number = paragraph_keys[key]
+            entity_keys.append(model.get_key(
+                str(number), 'Paragraph',
+                parent=model.get_key(story_id, 'Story')))
+    entities = dict(zip(missing, db.get(entity_keys))) if entity_keys else {}
+
+    prefetched = {'get_story': {}, 'get_paragraph': {}}
+    for key, story_id in story_keys.iteritems():
+        prefetched['get_story'][(('id', story_id),)] = \
+            lambda story_id=story_id, story=entities.get(key): \
+                _get_story(story_id, story)
+    for key, (story_id, number) in paragraph_keys.iteritems():
+        prefetched['get_paragraph'][(('number', number),
+                                     ('story_id', story_id))] = \
+            lambda story_id=story_id, number=number, \
+                   paragraph=entities.get(key): \
+                _get_paragraph(story_id, number, paragraph)
+    return prefetched
+
+@public
+@versioned(lambda query, after=None, limit=None:
+           get_search_version(query, after, limit))
+@metrics.timed('controller')
+def search(handler, query, after=None, limit=None):
+    """Finds the paragraphs that contain the words of a query. Paragraphs that
+    contain every word rank first, and rare words count for more than common
+    ones. Only the first SEARCH_MAX_TERMS words of the query are used.
+
+    At most limit paragraphs (defaults to the SEARCH_PAGE_SIZE setting) are
+    returned as JSON, together with a cursor for the next paragraphs, which
+    is null if there are no more. To get them, pass the cursor as after.
+
+    """
+    words, offset, limit = _get_search_page(query, after, limit)
+    ranked = _get_search_results(words)
+    results = ranked[offset:offset + limit]
+    query_hash = hashlib.md5(' '.join(words).encode('utf-8')).hexdigest()
+
+    def build():
+        keys = [model.get_key(str(number), 'Paragraph',
+                              parent=model.get_key(story_id, 'Story'))
+                for story_id, number in results]
+        records = [p.get_record() for p in db.get(keys) if p]
+        if offset + limit < len(ranked):
+            cursor_json = '"%s"' % _encode_search_cursor(words,
+                                                         offset + limit)
+        else:
+            cursor_json = 'null'
+        return '{"results":%s,"cursor":%s}' % (
+            utils.records_to_json(model.add_pending_branches(records)),
+            cursor_json)
+
+    return utils.JsonText(cache.get(cache.get_versioned_key(
+        'search:%s:%d:%d' % (query_hash, offset, limit),
+        _get_search_generations(words, results)), build))
+
+@public
+@versioned(lambda name, after=None, limit=None: get_feeds_version())
+@metrics.timed('controller')
+def get_feed(handler, name, after=None, limit=None):
+    """Retrieves a list of stories: "recent" lists the most recently continued
+    stories, "longest" the stories with the most paragraphs and "branches"
+    the newest branches. Each story comes with the text of its last
+    paragraph.
+
+    The feeds are rebuilt shortly after stories are written to, rather than
+    on every request. At most limit stories (defaults to the FEED_PAGE_SIZE
+    setting) are returned as JSON, together with a cursor for the next
+    stories, which is null if there are no more. To get them, pass the cursor
+    as after.
+
+    """
+    if not isinstance(name, basestring):
+        raise TypeError('Name must be a string.')
+    if name not in model.FEEDS:
+        raise storyteller.NotFoundError('There is no feed named %s.' % name)
+    if after is None:
+        offset = 0
+    elif isinstance(after, basestring):
+        offset = _decode_feed_cursor(name, after)
+    else:
+        raise TypeError('After must be a cursor.')
+    if limit is None:
+        limit = settings.FEED_PAGE_SIZE
+    if not isinstance(limit, (int, long)):
+        raise TypeError('Limit must be an integer.')
+    if not 1 <= limit <= settings.FEED_SIZE:
+        raise ValueError('Limit must be between 1 and %d.' %
+                         settings.FEED_SIZE)
+
+    records = _get_feed_records(name)
+    if offset + limit < len(records):
+        cursor = _encode_feed_cursor(name, offset + limit)
+    else:
+        cursor = None
+    return {'stories': records[offset:offset + limit], 'cursor': cursor}
+
+@public
+@metrics.timed('controller')
+def vote(handler, story_id, number, good):
+    """Votes a paragraph up (if good is true) or down. Voters are told apart by
+    their account if they are signed in, otherwise by a cookie, and can only
+    vote once on each paragraph. The vote counts and score of the paragraph
+    are updated shortly after the vote.
+
+    """
+    if not isinstance(story_id, (int, long)):
+        raise TypeError('Story id must be an integer.')
+    if not isinstance(number, (int, long)):
+        raise TypeError('Paragraph number must be an integer.')
+    if not isinstance(good, bool):
+        raise TypeError('Good must be true or false.')
+
+    # Make sure that the paragraph exists. It is usually cached.
+    _get_paragraph(story_id, number)
+    model.add_vote(story_id, number, _get_voter_id(handler), good)
+
+    return {'story_id': story_id, 'number': number, 'good': good}
+
+@public
+@metrics.timed('controller')
 def create_story(handler):
     """Creates a new, empty story.
 
@@ -113,69 +809,295 @@ def create_story(handler):
 
     return {'story_id': story.key().id()}
 
+@metrics.timed('controller')
+def warm_paragraphs(handler, story_id, page):
+    """Caches a page of paragraphs of a story. Called from the task queue;
+    not public.
+
+    """
+    _get_paragraphs(story_id, page)
+
+@metrics.timed('controller')
+def update_feeds(handler):
+    """Rebuilds the feeds. Called from the task queue; not public.
+
+    """
+    model.update_feeds()
+    cache.increment_generations(['feeds'])
+
+@metrics.timed('controller')
+def fold_votes(handler, story_id, number):
+    """Collects the vote counts of a paragraph into the paragraph. Called from
+    the task queue; not public.
+
+    """
+    paragraph = model.fold_votes(story_id, number)
+    if not paragraph:
+        return
+
+    # The votes are shown with the paragraph, and the score ranks it among
+    # the branches of the paragraph it follows.
+    invalidated = [story_id]
+    parent_key = model.Paragraph.follows.get_value_for_datastore(paragraph)
+    if parent_key and parent_key.parent().id() != story_id:
+        invalidated.append(parent_key.parent().id())
+    cache.increment_generations(invalidated)
+
+@metrics.timed('controller')
+def fold_branch_count(handler, story_id, number):
+    """Collects the sharded branch counter of a paragraph into the paragraph.
+    Called from the task queue; not public.
+
+    """
+    model.fold_branch_count(story_id, number)
+
 @public
-def get_paragraph(handler, story_id, number):
-    """Retrieves a single paragraph and its branches.
+@versioned(lambda story_id, after=None, limit=None:
+           get_story_version(story_id))
+@metrics.timed('controller')
+def get_paragraphs(handler, story_id, after=None, limit=None):
+    """Retrieves a range of paragraphs of a story, including the paragraphs
+    it inherits from the stories it was branched off of.
+
+    The range starts after the paragraph specified by after, which is either
+    a paragraph number or a cursor returned by a previous call, and holds at
+    most limit paragraphs (defaults to the PAGE_SIZE setting). The result is
+    returned as JSON with the paragraphs and a cursor for the paragraphs that
+    follow them, which is null at the end of the story.
+
+    """
+    if not isinstance(story_id, (int, long)):
+        raise TypeError('Story id must be an integer.')
+    if after is None:
+        number = 0
+    elif isinstance(after, (int, long)):
+        number = after
+    elif isinstance(after, basestring):
+        number = _decode_cursor(story_id, after)
+    else:
+        raise TypeError('After must be a paragraph number or a cursor.')
+    if number < 0:
+        raise ValueError('Invalid paragraph number.')
+    if limit is None:
+        limit = settings.PAGE_SIZE
+    if not isinstance(limit, (int, long)):
+        raise TypeError('Limit must be an integer.')
+    if not 1 <= limit <= settings.PARAGRAPHS_MAX_LIMIT:
+        raise ValueError('Limit must be between 1 and %d.' %
+                         settings.PARAGRAPHS_MAX_LIMIT)
+
+    first_page = model.get_page_number(number + 1)
+    last_page = model.get_page_number(number + limit)
+    pages = [_get_paragraphs(story_id, page)
+             for page in xrange(first_page, last_page + 1)]
+
+    if number % settings.PAGE_SIZE == 0 and limit % settings.PAGE_SIZE == 0:
+        # The range is made of whole pages, so their cached JSON can be used
+        # as it is. Only the last page needs to be counted, to tell whether
+        # there are more paragraphs.
+        count = (len(pages) - 1) * settings.PAGE_SIZE + len(pages[-1].load())
+        paragraphs_json = '[%s]' % ','.join([page[1:-1] for page in pages
+                                             if page != '[]'])
+    else:
+        records = []
+        for page in pages:
+            records.extend(page.load())
+        start = model.get_page_range(first_page)[0]
+        records = records[number + 1 - start:number + 1 - start + limit]
+        count = len(records)
+        paragraphs_json = utils.records_to_json(records)
+
+    last = number + count
+    if count < limit:
+        cursor_json = 'null'
+    else:
+        cursor_json = '"%s"' % _encode_cursor(story_id, last)
+        # Readers who are close to the end of a page will soon ask for the
+        # next one.
+        page_end = model.get_page_range(model.get_page_number(last))[1]
+        if page_end - last < settings.PAGE_PREFETCH_DISTANCE:
+            try:
+                _warm_page(story_id, page_end)
+            except:
+                logging.exception('Failed to warm the next page:')
+
+    return utils.JsonText('{"paragraphs":%s,"cursor":%s}' % (paragraphs_json,
+                                                              cursor_json))
+
+@public
+@versioned(lambda story_id, depth=None, max_nodes=None:
+           get_tree_version(story_id))
+@metrics.timed('controller')
+def get_story_tree(handler, story_id, depth=None, max_nodes=None):
+    """Retrieves the branch tree that a story belongs to: the story that the
+    tree starts with and every story that was branched off of it, directly or
+    through other branches. The tree is returned as JSON, with a list of
+    nodes ordered by depth, where each node has the id of the story it was
+    branched off of and the number of the paragraph it continues.
+
+    Only branches up to depth levels below the root are included, and at most
+    max_nodes nodes (defaults to the TREE_MAX_NODES setting). If there are
+    more nodes, "truncated" is true.
+
+    """
+    if not isinstance(story_id, (int, long)):
+        raise TypeError('Story id must be an integer.')
+    if depth is not None:
+        if not isinstance(depth, (int, long)):
+            raise TypeError('Depth must be an integer.')
+        if depth < 0:
+            raise ValueError('Depth must not be negative.')
+    if max_nodes is None:
+        max_nodes = settings.TREE_MAX_NODES
+    if not isinstance(max_nodes, (int, long)):
+        raise TypeError('The maximum number of nodes must be an integer.')
+    if not 1 <= max_nodes <= settings.TREE_MAX_NODES:
+        raise ValueError('The maximum number of nodes must be between 1 and '
+                         '%d.' % settings.TREE_MAX_NODES)
+
+    root_id = _get_root_id(story_id)
+    tree_id = _get_tree_id(root_id)
+
+    def build():
+        query = model.StoryTreeNode.all().filter('root_id =', root_id)
+        if depth is not None:
+            query.filter('depth <=', depth)
+        nodes = query.order('depth').fetch(max_nodes + 1)
+        return utils.to_json({
+            'root_id': root_id,
+            'nodes': [node.get_record() for node in nodes[:max_nodes]],
+            'truncated': len(nodes) > max_nodes})
+
+    generation = cache.get_generations([tree_id])[tree_id]
+    key = cache.get_versioned_key(
+        'tree:%d:%s:%d' % (root_id, depth, max_nodes), [generation])
+    return utils.JsonText(cache.get(key, build))
+
+@public
+@versioned(lambda story_id, number, after=None, limit=None,
+                  order='num_branches': get_story_version(story_id))
+@metrics.timed('controller')
+def get_paragraph(handler, story_id, number, after=None, limit=None,
+                  order='num_branches'):
+    """Retrieves a single paragraph and its branches. The paragraph is returned
+    as JSON.
+
+    The branches are the paragraphs that continue the paragraph, ranked by
+    order: "num_branches" (the default) lists the most continued ones first
+    and "score" the ones with the best votes. At most limit branches
+    (defaults to the BRANCHES_PAGE_SIZE setting) are returned, together with
+    a cursor for the rest, which is null if there are no more branches. To
+    get the rest, pass the cursor as after.
 
     """
     if not isinstance(story_id, (int, long)):
         raise TypeError('Story id must be an integer.')
     if not isinstance(number, (int, long)):
         raise TypeError('Paragraph number must be an integer.')
+    if after is not None and not isinstance(after, basestring):
+        raise TypeError('After must be a cursor.')
+    if limit is None:
+        limit = settings.BRANCHES_PAGE_SIZE
+    if not isinstance(limit, (int, long)):
+        raise TypeError('Limit must be an integer.')
+    if not 1 <= limit <= settings.BRANCHES_MAX_LIMIT:
+        raise ValueError('Limit must be between 1 and %d.' %
+                         settings.BRANCHES_MAX_LIMIT)
+    if order not in model.BRANCH_ORDERS:
+        raise ValueError('Order must be one of %s.' %
+                         ', '.join(model.BRANCH_ORDERS))
 
-    cache_key = 'paragraph:%d:%d' % (story_id, number)
-    data = memcache.get(cache_key)
-    if data:
-        return data
+    return _get_paragraph(story_id, number, after=after, limit=limit,
+                          order=order)
 
-    story_key = model.get_key(story_id, 'Story')
-    paragraph = model.Paragraph.get_by_key_name(str(number), parent=story_key)
-    if not paragraph:
-        raise storyteller.ParagraphNotFoundError('Paragraph not found.')
+def _get_paragraph(story_id, number, paragraph=None, after=None, limit=None,
+                   order='num_branches'):
+    if limit is None:
+        limit = settings.BRANCHES_PAGE_SIZE
+    last = after and _decode_branch_cursor(story_id, number, order, after)
 
-    data = {'story_id': story_id, 'number': paragraph.number,
-            'created': paragraph.created, 'text': paragraph.text,
-            'branches': [{'story_id': p.key().parent().id(),
-                          'number': p.number, 'created': p.created,
-                          'text': p.text, 'num_branches': p.num_branches}
-                         for p in paragraph.branches]}
+    def build():
+        instance = paragraph or model.Paragraph.get_by_key_name(
+            str(number), parent=model.get_key(story_id, 'Story'))
+        if not instance:
+            raise storyteller.ParagraphNotFoundError('Paragraph not found.')
 
-    memcache.set(cache_key, data)
-    return data
+        # Get one more branch than needed to know if there are more.
+        branches = instance.get_branches(limit + 1, last, order)
+        if len(branches) > limit:
+            branches = branches[:limit]
+            cursor = _encode_branch_cursor(story_id, number, order,
+                                           branches[-1])
+        else:
+            cursor = None
+        return utils.paragraph_to_json({
+            'story_id': story_id, 'number': instance.number,
+            'created': instance.get_created_timestamp(),
+            'text': instance.text,
+            'votes_up': instance.votes_up,
+            'votes_down': instance.votes_down,
+            'score': instance.score,
+            'branches': model.add_pending_branches(
+                [p.get_record() for p in branches]),
+            'branches_cursor': cursor})
+
+    if after or limit != settings.BRANCHES_PAGE_SIZE or \
+            order != 'num_branches':
+        # Only the first page of branches in the default order is kept up to
+        # date by add_paragraph; the other pages are rebuilt when the story
+        # changes.
+        generations = cache.get_generations([story_id])
+        key = cache.get_versioned_key('paragraph:%d:%d:%s:%s:%d' % (
+            story_id, number, order, after or '', limit),
+            [generations[story_id]])
+    else:
+        key = _get_paragraph_key(story_id, number)
+    return utils.JsonText(cache.get(key, build))
 
 @public
+@versioned(lambda id=None: id and get_story_version(id))
+@metrics.timed('controller')
 def get_story(handler, id=None):
-    """Retrieves a single story.
+    """Retrieves a single story, with its first page of paragraphs. The story
+    is returned as JSON.
     
     """
     if id is not None and not isinstance(id, (int, long)):
         raise TypeError('Story id must be an integer.')
 
     if id:
-        data = memcache.get('story:%d' % id)
-        if data:
-            return data
+        return _get_story(id)
 
-        story = model.Story.get_by_id(id)
-        if not story:
-            raise storyteller.StoryNotFoundError('Story not found.')
+    # Start with the most recently continued story.
+    records = _get_feed_records('recent')
+    if records:
+        return _get_story(records[0]['story_id'])
+
+    # No story has been written to yet. Get the first story, or create one.
+    story = model.Story.all().get()
+    if not story:
+        story = model.Story()
+        story.put()
+    return _get_story(story.key().id(), story)
+
+def _get_story(id, story=None):
+    if story:
+        ancestry = story.get_ancestry()
     else:
-        # Get first story, or create one.
-        story = model.Story.all().get()
-        if not story:
-            story = model.Story()
-            story.put()
-        id = story.key().id()
-
-        data = memcache.get('story:%d' % id)
-        if data:
-            return data
+        ancestry = _get_ancestry(id)
+
+    def build():
+        instance = story or model.Story.get_by_id(id)
+        if not instance:
+            raise storyteller.StoryNotFoundError('Story not found.')
 
-    data = {'id': id, 'length': story.length,
-            'branches': [{'story_id': b.parent().id(),
-                          'paragraph_number': int(b.name())}
-                         for b in story.branches],
-            'paragraphs': _get_paragraphs(story)}
+        # The first page has already been serialized, so it is inserted into
+        # the story data as it is.
+        return utils.story_to_json(
+            {'id': id, 'length': instance.length,
+             'branches': [{'story_id': b.parent().id(),
+                           'paragraph_number': int(b.name())}
+                          for b in instance.branches]},
+            _get_paragraphs(instance))
 
-    memcache.set('story:%d' % id, data)
-    return data
+    return utils.JsonText(cache.get(_get_story_key(id, ancestry), build))
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Per-request instrumentation.
+
+Every request handled through middleware() gets a record of how many
+datastore calls it made, how the cache served it and how long it spent in
+timed sections such as JSON serialization and template rendering. When the
+request is done, the record is logged as a single line of JSON and added to
+in-process aggregates, which the admin stats page shows.
+
+Outside of a request, the functions in this module do nothing.
+
+"""
+
+import logging
+import threading
+import time
+
+from django.utils import simplejson
+
+from storyteller import settings
+
+# The names that datastore calls are counted under.
+DATASTORE_CALLS = {'Get': 'get', 'Put': 'put', 'Delete': 'delete',
+                   'RunQuery': 'query', 'Count': 'query', 'Next': 'next'}
+
+_local = threading.local()
+_lock = threading.Lock()
+_aggregates = {}
+_since = time.time()
+
+
+class Record(object):
+    """The measurements of a single request.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.counters = {}
+        self.timers = {}
+        self._running = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def start_timer(self, name):
+        # Only the outermost of nested sections with the same name is timed.
+        depth = self._running.get(name, (0, None))[0]
+        if depth:
+            self._running[name] = (depth + 1, self._running[name][1])
+        else:
+            self._running[name] = (1, time.time())
+
+    def stop_timer(self, name):
+        depth, start = self._running[name]
+        if depth > 1:
+            self._running[name] = (depth - 1, start)
+            return
+        del self._running[name]
+        self.timers[name] = self.timers.get(name, 0.0) + time.time() - start
+
+    def to_dict(self):
+        return {'name': self.name,
+                'latency_ms': round((time.time() - self.start) * 1000, 3),
+                'counters': self.counters,
+                'timers_ms': dict((name, round(value * 1000, 3))
+                                  for name, value in self.timers.iteritems())}
+
+class _Samples(object):
+    """Keeps the latest samples of a value, for calculating percentiles.
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.values = []
+        self.index = 0
+
+    def add(self, value):
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            self.values[self.index] = value
+            self.index = (self.index + 1) % self.size
+
+    def percentiles(self):
+        values = sorted(self.values)
+        if not values:
+            return None
+        def at(fraction):
+            return values[min(int(len(values) * fraction), len(values) - 1)]
+        return {'p50': at(.5), 'p90': at(.9), 'p99': at(.99),
+                'max': values[-1]}
+
+class _Aggregate(object):
+    """The measurements of all requests with the same name.
+
+    """
+    def __init__(self):
+        self.requests = 0
+        self.counters = {}
+        self.latency = _Samples(settings.METRICS_SAMPLES)
+        self.timers = {}
+
+    def add(self, data):
+        self.requests += 1
+        self.latency.add(data['latency_ms'])
+        for name, value in data['counters'].iteritems():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for name, value in data['timers_ms'].iteritems():
+            if name not in self.timers:
+                self.timers[name] = _Samples(settings.METRICS_SAMPLES)
+            self.timers[name].add(value)
+
+    def to_dict(self):
+        counters = dict(self.counters)
+        # Calculate the hit ratio of every key family in the cache.
+        families = set(name.split('.')[1] for name in counters
+                       if name.startswith('cache.'))
+        ratios = {}
+        for family in families:
+            hits = (counters.get('cache.%s.local_hits' % family, 0) +
+                    counters.get('cache.%s.memcache_hits' % family, 0))
+            total = hits + counters.get('cache.%s.misses' % family, 0)
+            if total:
+                ratios[family] = round(float(hits) / total, 4)
+        timers = self.timers.iteritems()
+        return {'requests': self.requests,
+                'latency_ms': self.latency.percentiles(),
+                'timers_ms': dict((name, samples.percentiles())
+                                  for name, samples in timers),
+                'counters': counters,
+                'cache_hit_ratios': ratios}
+
+
+def current():
+    """Returns the record of the current request, or None if there is none.
+
+    """
+    return getattr(_local, 'record', None)
+
+def set_name(name):
+    """Sets the name that the current request is aggregated under.
+
+    """
+    record = current()
+    if record:
+        record.name = name
+
+def count(name, amount=1):
+    record = current()
+    if record and amount:
+        record.count(name, amount)
+
+def count_cache(key, result):
+    """Counts a cache lookup by the family of its key (the part before the
+    first colon). The result is one of 'local_hits', 'memcache_hits' and
+    'misses'.
+
+    """
+    record = current()
+    if record:
+        record.count('cache.%s.%s' % (key.split(':', 1)[0], result))
+
+def start_timer(name):
+    record = current()
+    if record:
+        record.start_timer(name)
+
+def stop_timer(name):
+    record = current()
+    if record:
+        record.stop_timer(name)
+
+def timed(name):
+    """A decorator that adds the time spent in a function to the named timer
+    of the current request.
+
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            record = current()
+            if not record:
+                return func(*args, **kwargs)
+            record.start_timer(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record.stop_timer(name)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__dict__.update(func.__dict__)
+        return wrapper
+    return decorator
+
+def start_request(name):
+    _local.record = Record(name)
+
+def finish_request():
+    """Ends the current request, logs its record and adds it to the
+    aggregates.
+
+    """
+    record = current()
+    if not record:
+        return
+    _local.record = None
+
+    data = record.to_dict()
+    logging.info('metrics %s', simplejson.dumps(data, separators=(',', ':'),
+                                                sort_keys=True))
+    _lock.acquire()
+    try:
+        if record.name not in _aggregates:
+            _aggregates[record.name] = _Aggregate()
+        _aggregates[record.name].add(data)
+    finally:
+        _lock.release()
+
+def get_summary():
+    """Returns the aggregated measurements of the requests handled by this
+    instance, by request name.
+
+    """
+    _lock.acquire()
+    try:
+        requests = dict((name, aggregate.to_dict())
+                        for name, aggregate in _aggregates.iteritems())
+        return {'since': int(_since), 'requests': requests}
+    finally:
+        _lock.release()
+
+def reset():
+    global _since
+    _lock.acquire()
+    try:
+        _aggregates.clear()
+        _since = time.time()
+    finally:
+        _lock.release()
+
+def middleware(application):
+    """Wraps a WSGI application so that every request it handles is measured.
+    Handlers name their requests with set_name(); unnamed requests are
+    aggregated as 'other'.
+
+    """
+    def wrapper(environ, start_response):
+        start_request('other')
+        try:
+            return application(environ, start_response)
+        finally:
+            finish_request()
+    return wrapper
+
+def _datastore_hook(service, call, request, response):
+    name = DATASTORE_CALLS.get(call)
+    if name:
+        count('datastore.' + name)
+
+def _install_hooks():
+    if settings.STORAGE_BACKEND == 'sqlite':
+        from storyteller.backends import sqlite
+        sqlite.hooks.append(_datastore_hook)
+    else:
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'storyteller_metrics', _datastore_hook, 'datastore_v3')
+
+_install_hooks()
@@ -18,16 +18,32 @@
 # Storyteller. If not, see http://www.gnu.org/licenses/.
 #
 
+import array
+import bisect
+import calendar
+import cPickle as pickle
 from datetime import datetime
 import logging
+import math
+import random
 import re
 import string
+import time
 import uuid
 
-from google.appengine.ext import db
-
 import storyteller
 from storyteller import settings
+from storyteller.backends import db, memcache, taskqueue
+
+# The properties that the branches of a paragraph can be ranked by.
+BRANCH_ORDERS = ('num_branches', 'score')
+
+# The lists of stories that are kept up to date for the front page and the
+# get_feed API: the most recently continued stories, the longest stories and
+# the newest branches.
+FEEDS = ('recent', 'longest', 'branches')
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
 
 def get_key(value, kind, parent=None):
     """Returns a key from value.
@@ -76,10 +92,443 @@ def get_instance(value, model, parent=None):
         raise TypeError('Invalid type (value); expected string, number, Key '
                         'or %s.' % model.__name__)
 
+def increment_branch_count(paragraph_key):
+    """Increments the branch count of a paragraph by incrementing a random
+    shard of its counter. The shards are collected into the paragraph later
+    on by fold_branch_count, which is scheduled to run in the task queue.
+
+    Until then, the pending increments are also counted in memcache so that
+    they can be included when paragraph records are read.
+
+    """
+    shard = random.randint(0, settings.BRANCH_COUNTER_SHARDS - 1)
+    key_name = '%d:%s:%d' % (paragraph_key.parent().id(), paragraph_key.name(),
+                             shard)
+    # The pending count is incremented before the shard, so that a fold that
+    # collects the new shard value always finds it there to decrement.
+    pending_key = _get_pending_key(paragraph_key.parent().id(),
+                                   paragraph_key.name())
+    memcache.incr(pending_key, initial_value=0)
+    try:
+        db.run_in_transaction(_increment_shard, key_name)
+    except:
+        memcache.decr(pending_key)
+        raise
+
+    # Only one fold is scheduled per paragraph and time window. Task names
+    # that have already been used are rejected by the task queue.
+    window = int(time.time()) / settings.BRANCH_COUNT_FOLD_DELAY
+    try:
+        taskqueue.add(
+            name='fold-branch-count-%d-%s-%d' % (paragraph_key.parent().id(),
+                                                 paragraph_key.name(), window),
+            url='/tasks/fold_branch_count',
+            params={'story_id': paragraph_key.parent().id(),
+                    'number': paragraph_key.name()},
+            countdown=settings.BRANCH_COUNT_FOLD_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def fold_branch_count(story_id, number):
+    """Collects the shards of the branch counter of a paragraph into its
+    num_branches value (and the snapshot of its page).
+
+    Shards are never reset, so folding is idempotent; the paragraph remembers
+    how much of the shard total it has already collected.
+
+    """
+    paragraph_key = db.Key.from_path(
+        'Paragraph', str(number), parent=db.Key.from_path('Story', story_id))
+    keys = [db.Key.from_path(BranchCounterShard.kind(),
+                             '%d:%d:%d' % (story_id, number, i))
+            for i in xrange(settings.BRANCH_COUNTER_SHARDS)]
+    total = sum(shard.count for shard in db.get(keys) if shard)
+
+    folded = db.run_in_transaction(_fold_branch_count, paragraph_key, total)
+    if folded:
+        memcache.decr(_get_pending_key(story_id, number), folded)
+
+def add_pending_branches(records):
+    """Adds the branch count increments that have not been folded yet to a
+    list of paragraph records. Uses a single memcache round trip.
+
+    """
+    keys = [_get_pending_key(r['story_id'], r['number']) for r in records]
+    if not keys:
+        return records
+
+    pending = memcache.get_multi(keys)
+    for key, record in zip(keys, records):
+        if pending.get(key):
+            record['num_branches'] += int(pending[key])
+    return records
+
+def add_vote(story_id, number, voter_id, good):
+    """Adds the vote of a voter to a paragraph. Each voter can only vote once
+    on a paragraph; voting again raises VotesNotPossibleError.
+
+    The voter is looked up in a single shard of the voters of the paragraph,
+    picked by the voter id, and the vote is counted in the same shard. The
+    counts are collected into the paragraph later on by fold_votes, which is
+    scheduled to run in the task queue.
+
+    """
+    key_name = '%d:%d:%d' % (story_id, number,
+                             voter_id % settings.VOTE_SHARDS)
+    db.run_in_transaction(_add_vote, key_name, voter_id, good)
+
+    # Only one fold is scheduled per paragraph and time window, like for the
+    # branch counter.
+    window = int(time.time()) / settings.VOTE_FOLD_DELAY
+    try:
+        taskqueue.add(
+            name='fold-votes-%d-%d-%d' % (story_id, number, window),
+            url='/tasks/fold_votes',
+            params={'story_id': story_id, 'number': number},
+            countdown=settings.VOTE_FOLD_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def fold_votes(story_id, number):
+    """Collects the vote counts in the shards of a paragraph into the
+    paragraph, and updates its score. Returns the paragraph if it changed,
+    otherwise None.
+
+    The shards hold totals, so folding is idempotent.
+
+    """
+    paragraph_key = db.Key.from_path(
+        'Paragraph', str(number), parent=db.Key.from_path('Story', story_id))
+    keys = [db.Key.from_path(VoteCounter.kind(), 'count',
+                             parent=db.Key.from_path(
+                                 VoterSet.kind(),
+                                 '%d:%d:%d' % (story_id, number, i)))
+            for i in xrange(settings.VOTE_SHARDS)]
+    counters = [counter for counter in db.get(keys) if counter]
+    up = sum(counter.up for counter in counters)
+    down = sum(counter.down for counter in counters)
+    return db.run_in_transaction(_fold_votes, paragraph_key, up, down)
+
+def get_score(up, down):
+    """Returns the score of a paragraph with the specified numbers of up and
+    down votes: the lower bound of the 95% confidence interval of the share
+    of up votes (the Wilson score). A few votes count for less than many
+    votes with the same share.
+
+    """
+    n = up + down
+    if not n:
+        return 0.0
+    z = 1.96
+    p = float(up) / n
+    return (p + z * z / (2 * n) -
+            z * math.sqrt((p * (1 - p) + z * z / (4 * n)) / n)) / \
+        (1 + z * z / n)
+
+def schedule_feeds_update():
+    """Makes sure that the feeds are rebuilt after the current time window,
+    so that they include what has been written until then. Only one rebuild
+    is scheduled per window, however many stories are written to.
+
+    """
+    window = int(time.time()) / settings.FEED_UPDATE_DELAY
+    try:
+        taskqueue.add(name='update-feeds-%d' % window,
+                      url='/tasks/update_feeds',
+                      countdown=settings.FEED_UPDATE_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def update_feeds():
+    """Rebuilds every feed from the indexes of the stories, and stores them.
+    Returns a dict of the feed names mapped to the stored records.
+
+    """
+    feeds = dict((name, _build_feed(name)) for name in FEEDS)
+    db.put([Feed.create(name, records) for name, records in feeds.items()])
+    return feeds
+
+def get_feed(name):
+    """Returns the records of the stories in a feed. A feed that has never
+    been stored is built and stored.
+
+    """
+    if name not in FEEDS:
+        raise storyteller.NotFoundError('There is no feed named %s.' % name)
+    feed = Feed.get_by_key_name(name)
+    if feed:
+        return feed.get_records()
+    records = _build_feed(name)
+    Feed.create(name, records).put()
+    return records
+
+def normalize_text(text):
+    """Replaces repeating spaces, newlines, etc. with single spaces and trims
+    the text.
+
+    """
+    return re.sub(r'\s+', ' ', text).strip()
+
+def get_words(text):
+    """Returns the distinct words of a text in lower case, in the order they
+    first appear. Single characters and words longer than the
+    SEARCH_MAX_WORD_LENGTH setting are not counted as words.
+
+    """
+    words = []
+    seen = set()
+    for word in _WORD_RE.findall(normalize_text(unicode(text)).lower()):
+        if 1 < len(word) <= settings.SEARCH_MAX_WORD_LENGTH and \
+                word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+def search(words, limit):
+    """Returns the keys of up to limit paragraphs that contain any of the
+    specified words, best match first.
+
+    Each word is looked up with a keys only query for at most limit
+    paragraphs, and counts for more the fewer paragraphs it was found in.
+    Since common words may match more paragraphs than are looked at, the
+    paragraphs that contain every word are also looked up with a single
+    query, and rank first.
+
+    """
+    scores = {}
+    weights = []
+    for word in words:
+        keys = ParagraphIndex.all(keys_only=True).filter(
+            'words =', word).fetch(limit)
+        if not keys:
+            weights.append(0.0)
+            continue
+        weight = math.log(1 + float(limit) / len(keys))
+        weights.append(weight)
+        for key in keys:
+            scores[key] = scores.get(key, 0.0) + weight
+
+    if len(words) > 1 and min(weights) > 0:
+        query = ParagraphIndex.all(keys_only=True)
+        for word in words:
+            query.filter('words =', word)
+        total = sum(weights)
+        for key in query.fetch(limit):
+            scores[key] = total
+
+    # Ties are broken by key, so that the order is the same every time.
+    ranked = sorted(scores.iteritems(), key=lambda item: (-item[1], item[0]))
+    return [db.Key.from_path('Paragraph', key.name(), parent=key.parent())
+            for key, score in ranked[:limit]]
+
+def get_owners(ancestry, story_id, start, end):
+    """Returns the stories that hold the paragraphs numbered start through end
+    of a story as a list of (story id, first number, last number) tuples,
+    taking branching into consideration. Only the branches that overlap the
+    range are visited.
+
+    Takes the branch index of the story (see Story.get_ancestry) and its id.
+
+    """
+    branch_ends, branch_story_ids = ancestry
+    owners = []
+    # Find the first branch that holds paragraphs in the range.
+    index = bisect.bisect_left(branch_ends, start)
+    number = start
+    while number <= end:
+        if index < len(branch_ends):
+            owner_id = branch_story_ids[index]
+            branch_end = min(branch_ends[index], end)
+        else:
+            # Any remaining paragraphs are from the story itself.
+            owner_id = story_id
+            branch_end = end
+
+        owners.append((owner_id, number, branch_end))
+        number = branch_end + 1
+        index += 1
+    return owners
+
+def get_page_number(paragraph_number):
+    """Returns the number of the page that the paragraph with the specified
+    number is on.
+
+    """
+    return (paragraph_number - 1) / settings.PAGE_SIZE + 1
+
+def get_page_range(page):
+    """Returns the numbers of the first and last paragraphs of a page.
+
+    """
+    start = (page - 1) * settings.PAGE_SIZE + 1
+    return start, start + settings.PAGE_SIZE - 1
+
+
+def _get_pending_key(story_id, number):
+    return 'pending_branches:%d:%s' % (story_id, number)
+
+def _increment_shard(key_name):
+    shard = BranchCounterShard.get_by_key_name(key_name)
+    if not shard:
+        shard = BranchCounterShard(key_name=key_name)
+    shard.count += 1
+    shard.put()
+
+def _fold_branch_count(paragraph_key, total):
+    paragraph = Paragraph.get(paragraph_key)
+    if not paragraph or total <= paragraph.folded_branches:
+        return 0
+
+    folded = total - paragraph.folded_branches
+    paragraph.num_branches += folded
+    paragraph.folded_branches = total
+    paragraph.put()
+    _update_snapshots(Story.get(paragraph_key.parent()), paragraph)
+    return folded
+
+def _build_feed(name):
+    if name == 'recent':
+        query = Story.all().order('-updated')
+    elif name == 'longest':
+        query = Story.all().order('-length')
+    else:
+        query = Story.all().filter('branched =', True).order('-created')
+    # Stories that nobody has written anything in yet are left out.
+    stories = [story for story in query.fetch(settings.FEED_SIZE)
+               if story.length]
+
+    # Show the latest paragraph of each story.
+    keys = [story.get_paragraph_keys(story.length, story.length)[0]
+            for story in stories]
+    return [story.get_feed_record(paragraph)
+            for story, paragraph in zip(stories, db.get(keys)) if paragraph]
+
+def _add_vote(key_name, voter_id, good):
+    voters = VoterSet.get_by_key_name(key_name)
+    if not voters:
+        voters = VoterSet(key_name=key_name)
+    if not voters.add(voter_id):
+        raise storyteller.VotesNotPossibleError(
+            'You have already voted on this paragraph.')
+
+    counter_key = db.Key.from_path(VoteCounter.kind(), 'count',
+                                   parent=db.Key.from_path(VoterSet.kind(),
+                                                           key_name))
+    counter = VoteCounter.get(counter_key)
+    if not counter:
+        counter = VoteCounter(key_name='count', parent=counter_key.parent())
+    if good:
+        counter.up += 1
+    else:
+        counter.down += 1
+    db.put([voters, counter])
+
+def _fold_votes(paragraph_key, up, down):
+    paragraph = Paragraph.get(paragraph_key)
+    if not paragraph or (paragraph.votes_up, paragraph.votes_down) == (up,
+                                                                      down):
+        return None
+
+    paragraph.votes_up = up
+    paragraph.votes_down = down
+    paragraph.score = get_score(up, down)
+    paragraph.put()
+    return paragraph
+
+def _build_snapshot(story_key, page):
+    snapshot = PageSnapshot.get_by_key_name(str(page), parent=story_key)
+    if snapshot:
+        return snapshot.get_records()
+
+    story = Story.get(story_key)
+    start, end = get_page_range(page)
+    start = max(start, story.get_first_number())
+    end = min(end, story.length)
+    if start > end:
+        return []
+
+    keys = [db.Key.from_path('Paragraph', str(i), parent=story_key)
+            for i in xrange(start, end + 1)]
+    records = [p.get_record() for p in db.get(keys) if p]
+
+    PageSnapshot.create(story_key, page, records).put()
+    return records
+
+def _update_snapshots(story, *paragraphs):
+    """Stores the records of the specified paragraphs in the snapshots of the
+    pages they are on. All paragraphs must belong to the specified story, and
+    this function must run in a transaction for the story's entity group.
+
+    """
+    pages = {}
+    for paragraph in paragraphs:
+        pages.setdefault(get_page_number(paragraph.number), []).append(
+            paragraph)
+
+    for page, page_paragraphs in pages.iteritems():
+        snapshot = PageSnapshot.get_by_key_name(str(page), parent=story.key())
+        if snapshot:
+            records = snapshot.get_records()
+        else:
+            records = []
+
+        for paragraph in sorted(page_paragraphs, key=lambda p: p.number):
+            record = paragraph.get_record()
+            if records and records[0]['number'] <= record['number'] <= \
+                    records[-1]['number']:
+                records[record['number'] - records[0]['number']] = record
+            elif records and records[-1]['number'] == record['number'] - 1:
+                records.append(record)
+            elif not records and record['number'] == max(
+                    get_page_range(page)[0], story.get_first_number()):
+                # This is the first paragraph the story owns on this page, so
+                # a new snapshot can be started.
+                records.append(record)
+            else:
+                # The snapshot is missing or does not line up with the
+                # paragraph. Leave it to be rebuilt when it is read.
+                records = None
+                break
+
+        if records:
+            if snapshot:
+                snapshot.set_records(records)
+            else:
+                snapshot = PageSnapshot.create(story.key(), page, records)
+            snapshot.put()
+        elif snapshot:
+            snapshot.delete()
+
+def _update_tree_node(story):
+    """Stores the length of a story in its node of the tree index, creating
+    the node if the story doesn't have one yet. Must run in a transaction for
+    the story's entity group.
+
+    """
+    node = StoryTreeNode.get_by_key_name('node', parent=story.key())
+    if not node:
+        # The last entry of the branch index is the story that this story was
+        # branched off of, and the first entry is the root of the tree.
+        branch_ends, branch_story_ids = story.get_ancestry()
+        if branch_story_ids:
+            node = StoryTreeNode(key_name='node', parent=story.key(),
+                                 root_id=branch_story_ids[0],
+                                 depth=len(branch_ends),
+                                 parent_id=branch_story_ids[-1],
+                                 branch_number=branch_ends[-1])
+        else:
+            node = StoryTreeNode(key_name='node', parent=story.key(),
+                                 root_id=story.key().id(), depth=0)
+    node.length = story.length
+    node.put()
 
 def _create_branch(story, paragraph, text):
+    branch_ends, branch_story_ids = story.get_ancestry()
     new_story = Story(
         branches=story.branches + [paragraph.key()],
+        branch_ends=branch_ends + [paragraph.number],
+        branch_story_ids=branch_story_ids + [story.key().id()],
+        branched=True,
         length=paragraph.number + 1)
     new_story.put()
 
@@ -89,7 +538,10 @@ def _create_branch(story, paragraph, text):
         number=new_story.length,
         follows=paragraph.key(),
         text=text)
-    new_paragraph.put()
+    db.put([new_paragraph, ParagraphIndex.create(new_paragraph)])
+
+    _update_snapshots(new_story, new_paragraph)
+    _update_tree_node(new_story)
 
     return new_story, new_paragraph
 
@@ -114,9 +566,6 @@ def _create_paragraph(paragraph_key, text):
             # should be created instead.
             return paragraph, story, None, True
 
-        paragraph.num_branches += 1
-        paragraph.put()
-
     story.length += 1
     story.put()
 
@@ -126,13 +575,25 @@ def _create_paragraph(paragraph_key, text):
         number=story.length,
         follows=paragraph_key,
         text=text)
-    new_paragraph.put()
+    db.put([new_paragraph, ParagraphIndex.create(new_paragraph)])
+
+    _update_snapshots(story, new_paragraph)
+    _update_tree_node(story)
 
     return paragraph, story, new_paragraph, False
 
 
 class Story(db.Model):
     branches = db.ListProperty(db.Key, indexed=False)
+    # An index of the paragraphs inherited through branching. Each value in
+    # branch_ends is the number of the last paragraph that belongs to the story
+    # with the id at the same position in branch_story_ids. Both lists are
+    # sorted since every branch continues where the previous one ended.
+    branch_ends = db.ListProperty(int, indexed=False)
+    branch_story_ids = db.ListProperty(int, indexed=False)
+    # Whether the story was branched off of another story, for the feed of
+    # the newest branches.
+    branched = db.BooleanProperty(default=False)
     length = db.IntegerProperty(default=0)
     created = db.DateTimeProperty(auto_now_add=True)
     updated = db.DateTimeProperty(auto_now=True)
@@ -157,9 +618,7 @@ class Story(db.Model):
         if not isinstance(text, basestring):
             raise TypeError('Invalid text; it must be a string.')
 
-        # Replace repeating spaces, newlines, etc. with single spaces and trim
-        # the text.
-        text = re.sub(r'\s+', ' ', text).strip()
+        text = normalize_text(text)
 
         if len(text) < 10:
             raise ValueError('That paragraph is too short.')
@@ -172,22 +631,90 @@ class Story(db.Model):
 
         base_paragraph, story, paragraph, needs_branch = db.run_in_transaction(
             _create_paragraph, paragraph_key, text)
-        if not needs_branch:
-            return base_paragraph, story, paragraph, False
-
-        # A paragraph was never created, which means a branch is needed to
-        # continue from the specified paragraph.
-        new_story, new_paragraph = db.run_in_transaction(_create_branch,
-            story, base_paragraph, text)
+        if needs_branch:
+            # A paragraph was never created, which means a branch is needed to
+            # continue from the specified paragraph.
+            story, paragraph = db.run_in_transaction(_create_branch,
+                story, base_paragraph, text)
+
+        if base_paragraph:
+            try:
+                # The branch count is sharded and incremented outside of the
+                # transactions above so that writers continuing the same
+                # paragraph don't collide on its entity group.
+                increment_branch_count(base_paragraph.key())
+            except:
+                logging.exception(
+                    'Failed to increment branch count for a paragraph:')
         try:
-            # This part has to run outside a transaction since the branched
-            # story is stored in a different entity group.
-            base_paragraph.num_branches += 1
-            base_paragraph.put()
+            schedule_feeds_update()
         except:
-            logging.exception(
-                'Failed to increment branch count for a paragraph:')
-        return base_paragraph, new_story, new_paragraph, True
+            logging.exception('Failed to schedule an update of the feeds:')
+        return base_paragraph, story, paragraph, needs_branch
+
+    def get_ancestry(self):
+        """Returns the branch index of this story as a tuple of two lists: the
+        number of the last paragraph of each branch and the id of the story
+        that owns the paragraphs of that branch.
+
+        Stories created before the index existed have it built from the
+        branches list instead.
+
+        """
+        if len(self.branch_ends) == len(self.branches):
+            return self.branch_ends, self.branch_story_ids
+        return ([int(b.name()) for b in self.branches],
+                [b.parent().id() for b in self.branches])
+
+    def get_feed_record(self, paragraph):
+        """Returns a dict with the data of this story that is shown in feeds,
+        including the text of the specified paragraph (the last one). Times
+        are UNIX timestamps, so that the record is ready to be serialized.
+
+        """
+        return {'story_id': self.key().id(), 'length': self.length,
+                'updated': calendar.timegm(self.updated.timetuple()),
+                'text': paragraph.text}
+
+    def get_first_number(self):
+        """Returns the number of the first paragraph that this story owns, as
+        opposed to inherits through branching.
+
+        """
+        branch_ends = self.get_ancestry()[0]
+        return branch_ends[-1] + 1 if branch_ends else 1
+
+    def get_owners(self, start, end):
+        """Returns the stories that hold the paragraphs numbered start through
+        end. See the get_owners function.
+
+        """
+        return get_owners(self.get_ancestry(), self.key().id(), start, end)
+
+    def get_owner_id(self, number):
+        """Returns the id of the story that holds the paragraph with the
+        specified number. This may be a story that this story was branched off
+        of.
+
+        """
+        branch_ends, branch_story_ids = self.get_ancestry()
+        index = bisect.bisect_left(branch_ends, number)
+        if index < len(branch_ends):
+            return branch_story_ids[index]
+        return self.key().id()
+
+    def get_paragraph_keys(self, start, end):
+        """Returns the keys of the paragraphs numbered start through end,
+        taking branching into consideration.
+
+        """
+        keys = []
+        for story_id, first, last in self.get_owners(start, end):
+            story_key = db.Key.from_path('Story', story_id)
+            for i in xrange(first, last + 1):
+                keys.append(db.Key.from_path('Paragraph', str(i),
+                                             parent=story_key))
+        return keys
 
 class Paragraph(db.Model):
     number = db.IntegerProperty(required=True)
@@ -195,8 +722,59 @@ class Paragraph(db.Model):
     text = db.StringProperty(indexed=False, required=True)
     follows = db.SelfReferenceProperty(collection_name='branches')
     num_branches = db.IntegerProperty(default=0)
-    good = db.ListProperty(int, indexed=False)
-    bad = db.ListProperty(int, indexed=False)
+    # The part of the branch counter shard total that has been added to
+    # num_branches.
+    folded_branches = db.IntegerProperty(default=0, indexed=False)
+    # The vote counts, as last folded from the vote counter shards (see
+    # add_vote), and the score calculated from them.
+    votes_up = db.IntegerProperty(default=0, indexed=False)
+    votes_down = db.IntegerProperty(default=0, indexed=False)
+    score = db.FloatProperty(default=0.0)
+
+    def get_created_timestamp(self):
+        """Returns the time the paragraph was created as a UNIX timestamp.
+
+        """
+        return calendar.timegm(self.created.timetuple())
+
+    def get_record(self):
+        """Returns a dict with the data of this paragraph that is shown in
+        paragraph lists. The creation time is a UNIX timestamp, so that the
+        record is ready to be serialized.
+
+        """
+        return {'story_id': self.key().parent().id(), 'number': self.number,
+                'created': self.get_created_timestamp(), 'text': self.text,
+                'num_branches': self.num_branches}
+
+    def get_branches(self, limit, after=None, order='num_branches'):
+        """Gets up to limit paragraphs that continue this paragraph, ranked by
+        the specified property ('num_branches' or 'score', as last folded)
+        and then by key.
+
+        To get the paragraphs after the ones already seen, pass the value of
+        the property and the key of the last one seen as the after tuple.
+        Paging this way costs the same no matter how many paragraphs came
+        before.
+
+        """
+        if order not in BRANCH_ORDERS:
+            raise ValueError('Branches cannot be ordered by %s.' % order)
+
+        branches = []
+        if after:
+            value, key = after
+            # First the rest of the paragraphs with the same value...
+            branches = Paragraph.all().filter('follows =', self).filter(
+                '%s =' % order, value).filter('__key__ >', key).order(
+                '__key__').fetch(limit)
+        if len(branches) < limit:
+            # ...and then the paragraphs with lower values.
+            query = Paragraph.all().filter('follows =', self)
+            if after:
+                query.filter('%s <' % order, after[0])
+            branches += query.order('-' + order).fetch(limit - len(branches))
+        return branches
 
     @classmethod
     def get_range(cls, story, start=1, end=None):
@@ -207,38 +785,188 @@ class Paragraph(db.Model):
         The range defaults to all paragraphs for the specified story.
 
         """
-        # Build a list of keys, fetching from the appropriate stories if the
-        # story has been branched.
-        keys = []
         story = get_instance(story, Story)
-        if not end:
+        if not end or end > story.length:
             end = story.length
-        branch_end = 0
-        for branch in story.branches:
-            branch_start = branch_end + 1
-            branch_end = int(branch.name())
-
-            if branch_end < start:
-                # The current branch ends before the desired paragraph. Check
-                # next one.
-                continue
-
-            for i in xrange(branch_start, branch_end + 1):
-                if i > end:
-                    # The key list has been built. Exit the loop.
-                    break
-                keys.append(db.Key.from_path(cls.kind(), str(i),
-                                             parent=branch.parent()))
-            # This is a trick to allow the above break statement to break
-            # two levels of for loops.
-            else:
-                continue
-            break
+        if start > end:
+            return []
+
+        paragraphs = db.get(story.get_paragraph_keys(start, end))
+        if None in paragraphs:
+            paragraphs = paragraphs[:paragraphs.index(None)]
+        return paragraphs
+
+class ParagraphIndex(db.Model):
+    """The words of a paragraph, for full-text search (see the search
+    function). The key name is the paragraph number and the parent is the
+    story, like for the paragraph itself, so that both are stored in the same
+    transaction.
+
+    The words are kept apart from the paragraph so that reading paragraphs
+    doesn't read their words too.
+
+    """
+    words = db.ListProperty(basestring)
+
+    @classmethod
+    def create(cls, paragraph):
+        """Returns a new, unsaved index of the words of a paragraph.
+
+        """
+        return cls(key_name=paragraph.key().name(),
+                   parent=paragraph.key().parent(),
+                   words=get_words(paragraph.text))
+
+class BranchCounterShard(db.Model):
+    """One shard of the branch counter of a paragraph. The key name is the
+    story id, the paragraph number and the shard index separated by colons.
+
+    Shards are root entities so that incrementing them never contends with the
+    entity group of the story.
 
-        # Any remaining paragraphs are from the current story.
-        for i in xrange(start + len(keys), end + 1):
-            keys.append(db.Key.from_path(cls.kind(), str(i),
-                                         parent=story.key()))
+    """
+    count = db.IntegerProperty(default=0, indexed=False)
+
+class StoryTreeNode(db.Model):
+    """A story in the tree index, which holds every story that was branched
+    off of the same root story, so that the branch structure can be read with
+    a single query. The key name is always "node" and the parent is the
+    story, so that the node is updated in the same transactions as the story.
+
+    """
+    # The id of the story that the tree starts with, and the number of
+    # branches between it and this story.
+    root_id = db.IntegerProperty(required=True)
+    depth = db.IntegerProperty(required=True)
+    # The id of the story that this story was branched off of, and the number
+    # of the paragraph it continues. Both are empty for the root story.
+    parent_id = db.IntegerProperty(indexed=False)
+    branch_number = db.IntegerProperty(default=0, indexed=False)
+    length = db.IntegerProperty(default=0, indexed=False)
+
+    def get_record(self):
+        """Returns a dict with the data of this node, ready to be serialized.
 
-        paragraphs = db.get(keys)
-        return paragraphs[:paragraphs.index(None)]
+        """
+        return {'story_id': self.key().parent().id(),
+                'parent_id': self.parent_id,
+                'branch_number': self.branch_number,
+                'length': self.length, 'depth': self.depth}
+
+class VoterSet(db.Model):
+    """One shard of the voters of a paragraph. The key name is the story id,
+    the paragraph number and the shard index separated by colons; voters are
+    assigned to shards by their id.
+
+    The voter ids are kept as a sorted array of 32-bit integers, so that
+    checking whether someone has voted is a binary search and each voter
+    takes four bytes.
+
+    """
+    data = db.BlobProperty()
+
+    def add(self, voter_id):
+        """Adds a voter to the set. Returns False if the voter was already in
+        it.
+
+        """
+        voters = array.array('I')
+        if self.data:
+            voters.fromstring(self.data)
+        index = bisect.bisect_left(voters, voter_id)
+        if index < len(voters) and voters[index] == voter_id:
+            return False
+        voters.insert(index, voter_id)
+        self.data = db.Blob(voters.tostring())
+        return True
+
+class VoteCounter(db.Model):
+    """The number of votes in one shard of the voters of a paragraph. The key
+    name is always "count" and the parent is the VoterSet, so that the vote
+    is counted in the same transaction as the voter is added, without having
+    to read the voters to fold the counts.
+
+    """
+    up = db.IntegerProperty(default=0, indexed=False)
+    down = db.IntegerProperty(default=0, indexed=False)
+
+class Feed(db.Model):
+    """The records of the stories in a feed (see Story.get_feed_record), as
+    last rebuilt by update_feeds. The key name is the name of the feed.
+
+    """
+    data = db.BlobProperty(required=True)
+    updated = db.DateTimeProperty(auto_now=True)
+
+    def get_records(self):
+        return pickle.loads(self.data)
+
+    @classmethod
+    def create(cls, name, records):
+        """Returns a new, unsaved feed with the specified records.
+
+        """
+        return cls(key_name=name, data=db.Blob(pickle.dumps(records, 2)))
+
+class PageSnapshot(db.Model):
+    """The records of the paragraphs that a story owns on one of its pages,
+    kept up to date as paragraphs are added. The key name is the page number
+    and the parent is the story.
+
+    Paragraphs that a story inherits through branching are kept in the
+    snapshots of the stories that own them.
+
+    """
+    data = db.BlobProperty(required=True)
+
+    def get_records(self):
+        records = pickle.loads(self.data)
+        for record in records:
+            # Snapshots from before records held timestamps have datetimes.
+            if isinstance(record['created'], datetime):
+                record['created'] = calendar.timegm(
+                    record['created'].timetuple())
+        return records
+
+    def set_records(self, records):
+        self.data = db.Blob(pickle.dumps(records, 2))
+
+    @classmethod
+    def create(cls, story_key, page, records):
+        """Returns a new, unsaved snapshot of a page of a story.
+
+        """
+        return cls(key_name=str(page), parent=story_key,
+                   data=db.Blob(pickle.dumps(records, 2)))
+
+    @classmethod
+    def get_page(cls, story, page):
+        """Gets the paragraph records of a page of the specified story. The
+        snapshots of all stories involved are fetched in a single batch get,
+        and missing snapshots are built from the paragraphs.
+
+        """
+        story = get_instance(story, Story)
+        start, end = get_page_range(page)
+        end = min(end, story.length)
+        if start > end:
+            return []
+
+        owners = story.get_owners(start, end)
+        keys = [db.Key.from_path(cls.kind(), str(page),
+                                 parent=db.Key.from_path('Story', story_id))
+                for story_id, first, last in owners]
+
+        records = []
+        for key, snapshot, (story_id, first, last) in zip(keys, db.get(keys),
+                                                          owners):
+            if snapshot:
+                owner_records = snapshot.get_records()
+            else:
+                owner_records = db.run_in_transaction(_build_snapshot,
+                                                      key.parent(), page)
+            # A snapshot of a story that has been branched off of may hold
+            # paragraphs that the specified story does not inherit.
+            records.extend(r for r in owner_records
+                           if first <= r['number'] <= last)
+        return records
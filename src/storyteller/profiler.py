@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Sampling profiler for production requests.
+
+One in every PROFILE_SAMPLE_RATE requests is run under cProfile, as is any
+request made by an administrator with the PROFILE_HEADER header set. The
+results are merged per request name (see metrics.set_name) and URL pattern
+in storyteller.urls, and shown as tables of the hottest functions on the
+/admin/profile page.
+
+The merged results can also be downloaded in the format of pstats, so that
+downloads from several instances can be merged with pstats.Stats.add().
+
+"""
+
+import cProfile
+import logging
+import marshal
+import os
+import random
+import re
+import threading
+
+from google.appengine.api import users
+
+from storyteller import metrics, settings
+
+_lock = threading.Lock()
+# Maps (name, pattern) tuples to pstats data: a dict of functions mapped to
+# (primitive calls, calls, total time, cumulative time, callers) tuples.
+_profiles = {}
+_requests = {}
+_patterns = None
+
+
+def _get_pattern(path):
+    """Returns the pattern in storyteller.urls that matches a path.
+
+    """
+    global _patterns
+    if _patterns is None:
+        # Imported here since the URL patterns import the views, which import
+        # this module.
+        from storyteller import urls
+        _patterns = [(re.compile('^%s$' % pattern), pattern)
+                     for pattern, handler in urls.urlpatterns]
+    for regexp, pattern in _patterns:
+        if regexp.match(path):
+            return pattern
+    return None
+
+def _should_profile(environ):
+    rate = settings.PROFILE_SAMPLE_RATE
+    if rate and random.randint(1, rate) == 1:
+        return True
+    header = 'HTTP_' + settings.PROFILE_HEADER.upper().replace('-', '_')
+    return header in environ and users.is_current_user_admin()
+
+def _add_stats(stats, other):
+    """Merges pstats data into other pstats data, like pstats.Stats.add()
+    does.
+
+    """
+    for func, (cc, nc, tt, ct, callers) in other.iteritems():
+        if func in stats:
+            old_cc, old_nc, old_tt, old_ct, old_callers = stats[func]
+            merged = dict(old_callers)
+            for caller, value in callers.iteritems():
+                if caller in merged:
+                    if isinstance(value, tuple):
+                        value = tuple([a + b for a, b in zip(merged[caller],
+                                                             value)])
+                    else:
+                        value += merged[caller]
+                merged[caller] = value
+            stats[func] = (old_cc + cc, old_nc + nc, old_tt + tt,
+                           old_ct + ct, merged)
+        else:
+            stats[func] = (cc, nc, tt, ct, dict(callers))
+
+def _get_stats(profile):
+    # pstats.Stats builds the same data, but also reads the source of every
+    # function, which is not needed here.
+    profile.create_stats()
+    return profile.stats
+
+def middleware(application):
+    """Wraps a WSGI application so that sampled requests are profiled. Requests
+    that are not sampled only cost a random number and a dict lookup.
+
+    """
+    def wrapper(environ, start_response):
+        if not _should_profile(environ):
+            return application(environ, start_response)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(application, environ, start_response)
+        finally:
+            try:
+                record = metrics.current()
+                key = (record and record.name or 'other',
+                       _get_pattern(environ.get('PATH_INFO', '')))
+                stats = _get_stats(profile)
+                _lock.acquire()
+                try:
+                    _add_stats(_profiles.setdefault(key, {}), stats)
+                    _requests[key] = _requests.get(key, 0) + 1
+                finally:
+                    _lock.release()
+            except:
+                logging.exception('Failed to collect a profile:')
+    return wrapper
+
+def _format_function(func):
+    filename, line, name = func
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
+
+def get_summary(limit=None):
+    """Returns the profiled requests of this instance by request name and URL
+    pattern, with a table of the functions that took the most time, not
+    counting the functions they called.
+
+    """
+    if limit is None:
+        limit = settings.PROFILE_TOP_FUNCTIONS
+    _lock.acquire()
+    try:
+        summary = []
+        for key, stats in _profiles.iteritems():
+            hot = sorted(stats.iteritems(), key=lambda item: -item[1][2])
+            functions = [{'function': _format_function(func),
+                          'calls': nc,
+                          'total_ms': round(tt * 1000, 3),
+                          'cumulative_ms': round(ct * 1000, 3)}
+                         for func, (cc, nc, tt, ct, callers) in hot[:limit]]
+            summary.append({'name': key[0], 'pattern': key[1],
+                            'requests': _requests[key],
+                            'functions': functions})
+        return summary
+    finally:
+        _lock.release()
+
+def dump(name=None):
+    """Returns the merged profiles of the requests with the specified name
+    (or of all requests), in the file format of pstats.
+
+    """
+    merged = {}
+    _lock.acquire()
+    try:
+        for key, stats in _profiles.iteritems():
+            if name is None or key[0] == name:
+                _add_stats(merged, stats)
+    finally:
+        _lock.release()
+    return marshal.dumps(merged)
+
+def reset():
+    _lock.acquire()
+    try:
+        _profiles.clear()
+        _requests.clear()
+    finally:
+        _lock.release()
@@ -18,6 +18,8 @@
 # Storyteller. If not, see http://www.gnu.org/licenses/.
 #
 
+from datetime import datetime
+
 from google.appengine.ext import webapp
 
 from storyteller import settings
@@ -36,3 +38,10 @@ def static(path):
     return '/s/%(version)s/%(path)s' % {
         'path': path,
         'version': settings.VERSION_HASH}
+
+@register.filter
+def timestamp(value):
+    """Turns a UNIX timestamp, as used in JSON data, into a datetime.
+
+    """
+    return datetime.utcfromtimestamp(value)
@@ -27,6 +27,16 @@ urlpatterns = (
     # API handler
     (r'/api/(\w+)', view.ApiHandler),
 
+    # Administration
+    (r'/admin/profile', view.ProfileHandler),
+    (r'/admin/stats', view.StatsHandler),
+
+    # Task queue handlers
+    (r'/tasks/fold_branch_count', view.FoldBranchCountHandler),
+    (r'/tasks/fold_votes', view.FoldVotesHandler),
+    (r'/tasks/update_feeds', view.UpdateFeedsHandler),
+    (r'/tasks/warm_paragraphs', view.WarmParagraphsHandler),
+
     # All other paths go to the 404 page
     (r'.*', view.NotFoundHandler),
 )
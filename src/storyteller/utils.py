@@ -18,9 +18,29 @@
 # Storyteller. If not, see http://www.gnu.org/licenses/.
 #
 
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+import gzip
 import time
 
-from storyteller import settings
+from django.utils import simplejson
+from django.utils.simplejson.encoder import encode_basestring_ascii
+
+from storyteller import metrics, settings
+
+
+class JsonText(str):
+    """A string of data that has already been serialized to JSON. Views write
+    it out as it is instead of serializing the data again.
+
+    """
+    @metrics.timed('json')
+    def load(self):
+        """Returns the data that the JSON represents.
+
+        """
+        return simplejson.loads(self)
+
 
 def _get_value(obj, name):
     """Gets a value from an object. First tries to get the attribute with the
@@ -74,6 +94,88 @@ def get_dict(obj, attributes):
 
     return result
 
+def compact(data):
+    """Returns a copy of data where every list of records (dicts with the same
+    keys and only simple values) is replaced by a dict of columns: each key
+    maps to a list of the values of the records, or to a single value if it
+    is the same for all records. The number of records is stored under the
+    "_compact" key.
+
+    This is used for the compact format of the API, since it avoids repeating
+    the keys of every paragraph.
+
+    """
+    if isinstance(data, dict):
+        return dict((key, compact(value)) for key, value in data.iteritems())
+    if not isinstance(data, (list, tuple)):
+        return data
+
+    items = [compact(item) for item in data]
+    if not items or not isinstance(items[0], dict):
+        return items
+    keys = set(items[0])
+    for item in items:
+        if not isinstance(item, dict) or set(item) != keys:
+            return items
+        for value in item.itervalues():
+            if isinstance(value, (dict, list, tuple)):
+                return items
+
+    columns = {'_compact': len(items)}
+    for key in keys:
+        values = [item[key] for item in items]
+        if len(items) > 1 and values.count(values[0]) == len(values):
+            columns[key] = values[0]
+        else:
+            columns[key] = values
+    return columns
+
+def gzip_string(data):
+    """Compresses a string with gzip.
+
+    """
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb',
+                      compresslevel=settings.GZIP_LEVEL)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return out.getvalue()
+
+def jsonify(obj):
+    """Takes complex data structures and returns them as data structures that
+    simplejson can handle.
+
+    """
+    # Return datetimes as a UNIX timestamp (seconds since 1970).
+    if isinstance(obj, datetime):
+        return int(time.mktime(obj.timetuple()))
+
+    # Return timedeltas as number of seconds.
+    if isinstance(obj, timedelta):
+        return obj.days * 86400 + obj.seconds + obj.microseconds / 1e6
+
+    # Since strings are iterable, return early for them.
+    if isinstance(obj, basestring):
+        return obj
+
+    # Handle dicts specifically.
+    if isinstance(obj, dict):
+        new_obj = {}
+        for key, value in obj.iteritems():
+            new_obj[key] = jsonify(value)
+        return new_obj
+
+    # Walk through iterable objects and return a jsonified list.
+    try:
+        iterator = iter(obj)
+    except TypeError:
+        # Return non-iterable objects as they are.
+        return obj
+    else:
+        return [jsonify(item) for item in iterator]
+
 def public(func):
     """A decorator that defines a function as publicly accessible.
 
@@ -81,6 +183,81 @@ def public(func):
     func.__public = True
     return func
 
+def versioned(get_version):
+    """A decorator that defines a public function as only reading data, and
+    gives it a function that takes the same arguments (without the handler)
+    and returns a string that changes whenever the data returned changes, or
+    None if there is no such string. The API handler uses it to answer
+    conditional requests without calling the function.
+
+    """
+    def decorator(func):
+        func.__version = get_version
+        return func
+    return decorator
+
+@metrics.timed('json')
+def to_json(data):
+    """Serializes data to JSON, in the compact format used for responses.
+
+    """
+    return simplejson.dumps(jsonify(data), separators=(',', ':'))
+
+# The functions below serialize the data that the controller returns. Since the
+# shape of the data is known, they are much faster than to_json, which has to
+# inspect every value.
+
+def record_to_json(record):
+    """Serializes a paragraph record (see Paragraph.get_record) to JSON.
+
+    """
+    return ('{"story_id":%d,"number":%d,"created":%d,"text":%s,'
+            '"num_branches":%d}' % (
+                record['story_id'], record['number'], record['created'],
+                encode_basestring_ascii(record['text']),
+                record['num_branches']))
+
+@metrics.timed('json')
+def records_to_json(records):
+    """Serializes a list of paragraph records to JSON.
+
+    """
+    return '[%s]' % ','.join([record_to_json(record) for record in records])
+
+@metrics.timed('json')
+def paragraph_to_json(paragraph, branches_json=None):
+    """Serializes the paragraph data returned by controller.get_paragraph to
+    JSON. The list of branches can be passed in already serialized.
+
+    """
+    if branches_json is None:
+        branches_json = records_to_json(paragraph['branches'])
+    cursor = paragraph.get('branches_cursor')
+    return ('{"story_id":%d,"number":%d,"created":%d,"text":%s,'
+            '"votes_up":%d,"votes_down":%d,"score":%s,'
+            '"branches":%s,"branches_cursor":%s}' % (
+                paragraph['story_id'], paragraph['number'],
+                paragraph['created'],
+                encode_basestring_ascii(paragraph['text']),
+                paragraph.get('votes_up', 0), paragraph.get('votes_down', 0),
+                repr(float(paragraph.get('score', 0.0))), branches_json,
+                cursor and '"%s"' % cursor or 'null'))
+
+@metrics.timed('json')
+def story_to_json(story, paragraphs_json=None):
+    """Serializes the story data returned by controller.get_story to JSON.
+    The list of paragraphs can be passed in already serialized.
+
+    """
+    if paragraphs_json is None:
+        paragraphs_json = records_to_json(story['paragraphs'])
+    branches_json = ','.join(['{"story_id":%d,"paragraph_number":%d}' % (
+                                  branch['story_id'],
+                                  branch['paragraph_number'])
+                              for branch in story['branches']])
+    return '{"id":%d,"length":%d,"branches":[%s],"paragraphs":%s}' % (
+        story['id'], story['length'], branches_json, paragraphs_json)
+
 def set_cookie(handler, name, value, expires=None, path='/'):
     # Build cookie data.
     if expires:
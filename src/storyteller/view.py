@@ -18,11 +18,10 @@
 # Storyteller. If not, see http://www.gnu.org/licenses/.
 #
 
-from datetime import datetime, timedelta
+import hashlib
 import logging
 import os
 import sys
-import time
 import traceback
 
 from django.utils import simplejson
@@ -31,11 +30,13 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
 import storyteller
-from storyteller import controller, settings
+from storyteller import cache, controller, metrics, profiler, settings, \
+    utils
+from storyteller.backends import taskqueue
 
 
-def _json(data):
-    return simplejson.dumps(jsonify(data), separators=(',', ':'))
+# Responses shorter than this are not worth compressing.
+GZIP_MIN_LENGTH = 200
 
 
 class TemplatedRequestHandler(webapp.RequestHandler):
@@ -65,6 +66,87 @@ class TemplatedRequestHandler(webapp.RequestHandler):
     def initialize(self, request, response):
         super(TemplatedRequestHandler, self).initialize(request, response)
 
+    def accepts_gzip(self):
+        """Returns True if the response should be compressed with gzip, which
+        depends on the GZIP_RESPONSES setting and the Accept-Encoding header of
+        the request.
+
+        """
+        if not settings.GZIP_RESPONSES:
+            return False
+        header = self.request.headers.get('Accept-Encoding', '')
+        for coding in header.split(','):
+            params = coding.split(';')
+            if params[0].strip().lower() != 'gzip':
+                continue
+            for param in params[1:]:
+                name, sep, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+
+    def write_body(self, body):
+        """Writes the response body, compressed with gzip if the client
+        accepts it.
+
+        """
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if settings.GZIP_RESPONSES:
+            self.response.headers['Vary'] = 'Accept-Encoding'
+        if len(body) >= GZIP_MIN_LENGTH and self.accepts_gzip():
+            self.write_gzipped(utils.gzip_string(body))
+        else:
+            self.response.out.write(body)
+
+    def write_gzipped(self, body):
+        """Writes a response body that has already been compressed with gzip.
+        Must only be used if accepts_gzip() returns True.
+
+        """
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        self.response.headers['Content-Encoding'] = 'gzip'
+        self.response.out.write(body)
+
+    def not_modified(self, *parts):
+        """Gives the response a strong ETag built from the specified parts,
+        which together must identify the version of everything that the
+        response depends on. Returns True if the client already has that
+        version, in which case the status is set to 304 and nothing should be
+        written.
+
+        If any of the parts is empty, no ETag is set and False is returned.
+
+        """
+        for part in parts:
+            if not part:
+                return False
+        if self.accepts_gzip():
+            # Compressed and uncompressed responses must not share a strong
+            # ETag.
+            parts += ('gzip',)
+
+        etag = '"%s"' % hashlib.md5(
+            ':'.join([settings.VERSION] + [str(part) for part in parts])
+        ).hexdigest()
+        self.response.headers['ETag'] = etag
+        # Make clients check the ETag every time instead of guessing how long
+        # the response stays fresh.
+        self.response.headers['Cache-Control'] = 'no-cache'
+
+        match = self.request.headers.get('If-None-Match')
+        if not match:
+            return False
+        tags = [tag.strip() for tag in match.split(',')]
+        if '*' in tags or etag in tags or 'W/' + etag in tags:
+            self.response.set_status(304)
+            return True
+        return False
+
     def not_found(self, template_name=None, **kwargs):
         """Similar to the render() method, but with a 404 HTTP status code.
         Also, the template_name argument is optional. If not specified, the
@@ -85,53 +167,35 @@ class TemplatedRequestHandler(webapp.RequestHandler):
         - request: The current request object. Has attributes such as 'path',
                    'query_string', etc.
 
+        """
+        self.response.out.write(self.render_string(template_name, **kwargs))
+
+    def render_string(self, template_name, **kwargs):
+        """Same as the render() method, but returns the output instead of
+        writing it.
+
         """
         kwargs.update({'request': self.request,
                        'settings': settings})
 
         path = os.path.join(settings.TEMPLATE_DIR, template_name)
-        self.response.out.write(template.render(path, kwargs))
-
+        metrics.start_timer('render')
+        try:
+            return template.render(path, kwargs)
+        finally:
+            metrics.stop_timer('render')
 
-def jsonify(obj):
-    """Takes complex data structures and returns them as data structures that
-    simplejson can handle.
-
-    """
-    # Return datetimes as a UNIX timestamp (seconds since 1970).
-    if isinstance(obj, datetime):
-        return int(time.mktime(obj.timetuple()))
-
-    # Return timedeltas as number of seconds.
-    if isinstance(obj, timedelta):
-        return obj.days * 86400 + obj.seconds + obj.microseconds / 1e6
-
-    # Since strings are iterable, return early for them.
-    if isinstance(obj, basestring):
-        return obj
-
-    # Handle dicts specifically.
-    if isinstance(obj, dict):
-        new_obj = {}
-        for key, value in obj.iteritems():
-            new_obj[key] = jsonify(value)
-        return new_obj
-
-    # Walk through iterable objects and return a jsonified list.
-    try:
-        iterator = iter(obj)
-    except TypeError:
-        # Return non-iterable objects as they are.
-        return obj
-    else:
-        return [jsonify(item) for item in iterator]
 
 class ApiHandler(TemplatedRequestHandler):
     """Opens up the controller module to HTTP requests. Arguments should be
     JSON encoded. Result will be JSON encoded.
 
+    The _format parameter selects the format of the result: "full" (the
+    default) or "compact", where lists of records are sent as columns.
+
     """
     def get(self, action):
+        metrics.set_name('api')
         res = self.response
 
         # Attempt to get the attribute in the controller module.
@@ -145,6 +209,7 @@ class ApiHandler(TemplatedRequestHandler):
             res.set_status(403)
             res.out.write('{"status":"forbidden"}')
             return
+        metrics.set_name('api.' + action)
 
         req = self.request
 
@@ -156,56 +221,255 @@ class ApiHandler(TemplatedRequestHandler):
                 if arg.startswith('_'): continue
                 kwargs[str(arg)] = simplejson.loads(req.get(arg))
 
-            data = attr(self, **kwargs) if callable(attr) else attr
-            result = {'status': 'success',
-                      'response': jsonify(data)}
+            # Functions that only read data can tell whether the client
+            # already has the current version, without reading anything.
+            get_version = getattr(attr, '__version', None)
+            version = get_version and get_version(**kwargs)
+            if self.not_modified('api', action, version):
+                return
+
+            # The compact format turns lists of records into columns (see
+            # utils.compact).
+            response_format = req.get('_format') or 'full'
+            if response_format not in ('full', 'compact'):
+                raise ValueError('Unknown format: %s' % response_format)
+
+            def build():
+                data = attr(self, **kwargs) if callable(attr) else attr
+                if response_format == 'compact':
+                    if isinstance(data, utils.JsonText):
+                        data = data.load()
+                    data = utils.compact(data)
+                elif isinstance(data, utils.JsonText):
+                    # The data has already been serialized, so it can be
+                    # written as it is.
+                    return '{"status":"success","response":%s}' % data
+                return utils.to_json({'status': 'success', 'response': data})
+
+            get_body = build
+            if version:
+                args_hash = hashlib.md5(
+                    utils.to_json(sorted(kwargs.items()))).hexdigest()
+                key = cache.get_versioned_key(
+                    'api:%s:%s:%s' % (action, response_format, args_hash),
+                    [version])
+                if response_format != 'full':
+                    # Converting the data is not free, so do it once per
+                    # version.
+                    get_body = lambda: cache.get(key, build)
+                if self.accepts_gzip():
+                    # Compress each version of the response only once.
+                    gzipped = cache.get(key + '.gz',
+                                        lambda: utils.gzip_string(get_body()))
+                    res.headers['Content-Type'] = 'application/json'
+                    self.write_gzipped(gzipped)
+                    return
+            body = get_body()
         except BaseException, e:
             logging.exception('API error:')
 
+            # Errors must not be answered with 304 later on.
+            del res.headers['ETag']
             res.set_status(400)
-            result = {'status': 'error',
-                      'response': str(e),
-                      'module': type(e).__module__,
-                      'type': type(e).__name__}
+            body = utils.to_json({'status': 'error',
+                                  'response': str(e),
+                                  'module': type(e).__module__,
+                                  'type': type(e).__name__})
 
         # Write the response as JSON.
         res.headers['Content-Type'] = 'application/json'
-        res.out.write(simplejson.dumps(result, separators=(',', ':')))
+        self.write_body(body)
 
 class StoryHandler(TemplatedRequestHandler):
     def get(self, story_id=None, paragraph_number=None):
+        metrics.set_name('story')
         if story_id is not None:
             story_id = int(story_id)
 
+        if not story_id:
+            try:
+                story = controller.get_story(self).load()
+            except storyteller.NotFoundError:
+                self.not_found()
+                return
+            self.redirect('/%d' % story['id'])
+            return
+
         try:
-            story = controller.get_story(self, story_id)
+            version = controller.get_story_version(story_id)
         except storyteller.NotFoundError:
             self.not_found()
             return
+        if self.not_modified('story', version):
+            return
 
-        if not story_id:
-            self.redirect('/%d' % story['id'])
+        # The rendered page only changes when the story does, so it is cached
+        # by the version of the story. Writes to the story change the version,
+        # which leaves the old pages unreachable.
+        key = cache.get_versioned_key(
+            'html:%s:%d:%s' % (settings.VERSION_HASH, story_id,
+                               paragraph_number or ''),
+            [version])
+        build = lambda: self.render_story(story_id, paragraph_number)
+        try:
+            if self.accepts_gzip():
+                # The compressed page is cached too, so that each version of
+                # the page is only compressed once.
+                self.write_gzipped(cache.get(key + '.gz',
+                    lambda: utils.gzip_string(cache.get(key, build))))
+            else:
+                self.write_body(cache.get(key, build))
+        except storyteller.NotFoundError:
+            # Errors must not be answered with 304 later on.
+            del self.response.headers['ETag']
+            del self.response.headers['Cache-Control']
+            self.not_found()
             return
 
+    def render_story(self, story_id, paragraph_number=None):
+        """Returns the page for a story, showing the story up to the specified
+        paragraph (defaults to the last one) as UTF-8 encoded HTML.
+
+        """
+        json_story = controller.get_story(self, story_id)
+        story = json_story.load()
+
         if paragraph_number is None:
             paragraph_number = story['length']
         else:
             paragraph_number = int(paragraph_number)
             if not 1 <= paragraph_number <= story['length']:
-                self.not_found()
-                return
+                raise storyteller.ParagraphNotFoundError(
+                    'Paragraph not found.')
             if paragraph_number < story['length']:
                 del story['paragraphs'][paragraph_number:]
+                json_story = utils.story_to_json(story)
 
         if paragraph_number:
-            paragraph = controller.get_paragraph(self, story_id,
-                                                 paragraph_number)
+            json_paragraph = controller.get_paragraph(self, story_id,
+                                                      paragraph_number)
+            paragraph = json_paragraph.load()
         else:
+            json_paragraph = 'null'
             paragraph = None
 
-        self.render('story.html',
-            json_story=_json(story), story=story,
-            json_paragraph=_json(paragraph), paragraph=paragraph)
+        body = self.render_string('story.html',
+            json_story=json_story, story=story,
+            json_paragraph=json_paragraph, paragraph=paragraph)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return body
+
+def _is_task_request(request):
+    """Returns True if a request was sent by the task queue.
+
+    """
+    if settings.STORAGE_BACKEND == 'sqlite':
+        return taskqueue.is_task_request(request)
+    # App Engine removes this header from requests that come from outside,
+    # and app.yaml only lets administrators request the task URLs directly.
+    return 'X-AppEngine-TaskName' in request.headers or \
+        users.is_current_user_admin()
+
+class FoldBranchCountHandler(webapp.RequestHandler):
+    """Task queue handler that collects the branch counter shards of a
+    paragraph.
+
+    """
+    def post(self):
+        if not _is_task_request(self.request):
+            self.error(403)
+            return
+        metrics.set_name('tasks.fold_branch_count')
+        controller.fold_branch_count(self, int(self.request.get('story_id')),
+                                     int(self.request.get('number')))
+
+class FoldVotesHandler(webapp.RequestHandler):
+    """Task queue handler that collects the vote counts of a paragraph.
+
+    """
+    def post(self):
+        if not _is_task_request(self.request):
+            self.error(403)
+            return
+        metrics.set_name('tasks.fold_votes')
+        controller.fold_votes(self, int(self.request.get('story_id')),
+                              int(self.request.get('number')))
+
+class UpdateFeedsHandler(webapp.RequestHandler):
+    """Task queue handler that rebuilds the feeds of stories.
+
+    """
+    def post(self):
+        if not _is_task_request(self.request):
+            self.error(403)
+            return
+        metrics.set_name('tasks.update_feeds')
+        controller.update_feeds(self)
+
+class WarmParagraphsHandler(webapp.RequestHandler):
+    """Task queue handler that caches a page of paragraphs ahead of the
+    readers who are about to ask for it.
+
+    """
+    def post(self):
+        if not _is_task_request(self.request):
+            self.error(403)
+            return
+        metrics.set_name('tasks.warm_paragraphs')
+        controller.warm_paragraphs(self, int(self.request.get('story_id')),
+                                   int(self.request.get('page')))
+
+class StatsHandler(webapp.RequestHandler):
+    """Shows the request measurements that this instance has collected (see
+    the metrics module) as JSON. Posting to it resets them. Only available to
+    administrators.
+
+    """
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        metrics.set_name('admin.stats')
+        data = metrics.get_summary()
+        data['cache'] = cache.stats
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(utils.to_json(data))
+
+    def post(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        metrics.reset()
+
+class ProfileHandler(webapp.RequestHandler):
+    """Shows the hottest functions of the requests that this instance has
+    profiled (see the profiler module) as JSON. With a download parameter,
+    the merged profiles are returned in the file format of pstats instead,
+    optionally only for the requests named by a name parameter. Posting to it
+    resets the profiles. Only available to administrators.
+
+    """
+    def get(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        metrics.set_name('admin.profile')
+        if self.request.get('download'):
+            name = self.request.get('name') or None
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            self.response.headers['Content-Disposition'] = \
+                'attachment; filename="%s.pstats"' % (name or 'all')
+            self.response.out.write(profiler.dump(name))
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(utils.to_json(profiler.get_summary()))
+
+    def post(self):
+        if not users.is_current_user_admin():
+            self.error(403)
+            return
+        profiler.reset()
 
 class NotFoundHandler(TemplatedRequestHandler):
     def get(self):
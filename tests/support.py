@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+"""Sets up Storyteller for the tests, which run against the 'sqlite' storage
+backend like the benchmarks do.
+
+Import this module before anything from storyteller, since the storage
+backend is picked when storyteller.backends is first imported.
+
+"""
+
+import atexit
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('CURRENT_VERSION_ID', 'test.1')
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/test')
+
+from storyteller import settings
+
+settings.STORAGE_BACKEND = 'sqlite'
+settings.SQLITE_DATABASE = tempfile.mktemp(suffix='.db',
+                                           prefix='storyteller-test-')
+# Keep the scheduled tasks from running in the middle of the tests. Tests
+# that need them run them directly.
+settings.BRANCH_COUNT_FOLD_DELAY = 24 * 3600
+settings.VOTE_FOLD_DELAY = 24 * 3600
+settings.FEED_UPDATE_DELAY = 24 * 3600
+
+from storyteller import cache, model
+from storyteller.backends import memcache
+
+
+def _remove_database():
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(settings.SQLITE_DATABASE + suffix):
+            os.remove(settings.SQLITE_DATABASE + suffix)
+
+atexit.register(_remove_database)
+
+
+class TestCase(unittest.TestCase):
+    """Starts every test with empty caches.
+
+    """
+    def setUp(self):
+        cache.local.clear()
+        memcache.flush_all()
+
+    def create_story(self, length):
+        """Creates a story with the specified number of paragraphs, and returns
+        its id.
+
+        """
+        story = model.Story()
+        story.put()
+        story_id = story.key().id()
+        for number in xrange(length):
+            model.Story.add_paragraph(story_id, number,
+                                      'Paragraph number %d.' % (number + 1))
+        return story_id
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+import threading
+import time
+import unittest
+
+import support
+
+from storyteller import cache, settings
+
+
+class RebuildTest(support.TestCase):
+    def test_waiters_take_over_a_failed_rebuild(self):
+        calls = []
+        def build():
+            calls.append(None)
+            # Give the other threads time to start waiting for this rebuild.
+            time.sleep(0.2)
+            if len(calls) == 1:
+                raise RuntimeError('The first rebuild fails.')
+            return 'value'
+
+        results = []
+        def run():
+            try:
+                results.append(cache.get('rebuild-test', build))
+            except RuntimeError:
+                results.append(None)
+
+        threads = [threading.Thread(target=run) for i in xrange(5)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # The waiters shouldn't wait out the lease of the failed rebuild.
+        self.assertTrue(time.time() - start < settings.CACHE_LEASE_TIME)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(results), [None] + ['value'] * 4)
+
+
+class LocalCacheTest(unittest.TestCase):
+    def test_concurrent_use(self):
+        local = cache.LocalCache(20000)
+        def run(seed):
+            for i in xrange(2000):
+                key = (seed * i) % 50
+                if i % 3 == 0:
+                    local.set(key, 'x' * (i % 300), ttl=i % 2 or None)
+                elif i % 3 == 1:
+                    local.get(key)
+                else:
+                    local.delete(key)
+
+        threads = [threading.Thread(target=run, args=(seed,))
+                   for seed in xrange(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Walk the linked list to check that it matches the entries.
+        keys = []
+        entry = local._root[local.NEXT]
+        while entry is not local._root:
+            keys.append(entry[local.KEY])
+            entry = entry[local.NEXT]
+        self.assertEqual(sorted(keys), sorted(local._entries))
+        self.assertEqual(local.size, sum(len(entry[local.DATA])
+                                         for entry in local._entries.values()))
+        self.assertTrue(local.size <= local.max_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
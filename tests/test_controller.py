@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+import unittest
+
+import support
+
+import storyteller
+from storyteller import controller, settings
+
+
+class Request(object):
+    def __init__(self, remote_addr):
+        self.cookies = {}
+        self.remote_addr = remote_addr
+
+
+class Response(object):
+    def __init__(self):
+        self.headers = {}
+
+
+class Handler(object):
+    """Stands in for the request handler that controller functions are
+    called with. Every handler is a new visitor without any cookies.
+
+    """
+    def __init__(self, remote_addr='127.0.0.1'):
+        self.request = Request(remote_addr)
+        self.response = Response()
+
+
+class User(object):
+    def __init__(self, user_id):
+        self._user_id = user_id
+
+    def user_id(self):
+        return self._user_id
+
+
+class BranchListTest(support.TestCase):
+    def test_cached_page_stays_bounded(self):
+        story_id = self.create_story(3)
+        # Cache the first page of branches while it has room.
+        controller.get_paragraph(None, story_id, 2)
+
+        # Paragraph 2 is already continued by paragraph 3, so together with
+        # the new branches there are five more than fit on a page.
+        for i in xrange(settings.BRANCHES_PAGE_SIZE + 4):
+            controller.add_paragraph(None, story_id, 2,
+                                     'Continuation number %d.' % i)
+
+        data = controller.get_paragraph(None, story_id, 2).load()
+        self.assertEqual(len(data['branches']), settings.BRANCHES_PAGE_SIZE)
+        self.assertTrue(data['branches_cursor'])
+
+        rest = controller.get_paragraph(
+            None, story_id, 2, after=data['branches_cursor']).load()
+        self.assertEqual(len(rest['branches']), 5)
+        self.assertEqual(rest['branches_cursor'], None)
+
+
+class SearchTest(support.TestCase):
+    def test_results_follow_branch_counts(self):
+        story_id = self.create_story(1)
+        controller.add_paragraph(None, story_id, 1,
+                                 'A lonely zeppelin drifts away.')
+        version = controller.get_search_version('zeppelin')
+        results = controller.search(None, 'zeppelin').load()['results']
+        self.assertEqual([(r['story_id'], r['number'], r['num_branches'])
+                          for r in results], [(story_id, 2, 0)])
+
+        controller.add_paragraph(None, story_id, 2,
+                                 'Nobody on the ground notices.')
+        self.assertNotEqual(controller.get_search_version('zeppelin'),
+                            version)
+        results = controller.search(None, 'zeppelin').load()['results']
+        self.assertEqual([(r['story_id'], r['number'], r['num_branches'])
+                          for r in results], [(story_id, 2, 1)])
+
+
+class VoteTest(support.TestCase):
+    def setUp(self):
+        super(VoteTest, self).setUp()
+        self.votes_per_hour = settings.ANONYMOUS_VOTES_PER_HOUR
+        settings.ANONYMOUS_VOTES_PER_HOUR = 3
+        self.get_current_user = controller.users.get_current_user
+
+    def tearDown(self):
+        settings.ANONYMOUS_VOTES_PER_HOUR = self.votes_per_hour
+        controller.users.get_current_user = self.get_current_user
+
+    def test_anonymous_votes_are_limited_per_address(self):
+        story_id = self.create_story(5)
+        for number in xrange(1, 4):
+            controller.vote(Handler(), story_id, number, True)
+        self.assertRaises(storyteller.VotesNotPossibleError, controller.vote,
+                          Handler(), story_id, 4, True)
+        controller.vote(Handler('10.0.0.2'), story_id, 4, True)
+
+    def test_signed_in_users_vote_once(self):
+        story_id = self.create_story(2)
+        controller.users.get_current_user = lambda: User('123')
+        controller.vote(Handler(), story_id, 1, True)
+        self.assertRaises(storyteller.VotesNotPossibleError, controller.vote,
+                          Handler(), story_id, 1, False)
+        controller.users.get_current_user = lambda: User('456')
+        controller.vote(Handler(), story_id, 1, False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+import unittest
+
+import support
+
+from storyteller import model
+from storyteller.backends import db
+
+
+class BranchCountTest(support.TestCase):
+    def get_record(self, story_id, number):
+        paragraph = model.Paragraph.get_by_key_name(
+            str(number), parent=db.Key.from_path('Story', story_id))
+        return model.add_pending_branches([paragraph.get_record()])[0]
+
+    def test_pending_count_is_folded(self):
+        story_id = self.create_story(2)
+        paragraph_key = db.Key.from_path(
+            'Paragraph', '2', parent=db.Key.from_path('Story', story_id))
+        for i in xrange(3):
+            model.increment_branch_count(paragraph_key)
+        self.assertEqual(self.get_record(story_id, 2)['num_branches'], 3)
+
+        model.fold_branch_count(story_id, 2)
+        self.assertEqual(self.get_record(story_id, 2)['num_branches'], 3)
+
+    def test_failed_increment_is_not_pending(self):
+        story_id = self.create_story(2)
+        paragraph_key = db.Key.from_path(
+            'Paragraph', '2', parent=db.Key.from_path('Story', story_id))
+
+        def fail(key_name):
+            raise db.TransactionFailedError('The shard is busy.')
+        increment_shard = model._increment_shard
+        model._increment_shard = fail
+        try:
+            self.assertRaises(db.TransactionFailedError,
+                              model.increment_branch_count, paragraph_key)
+        finally:
+            model._increment_shard = increment_shard
+        self.assertEqual(self.get_record(story_id, 2)['num_branches'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+import unittest
+
+import support
+
+from storyteller.backends import sqlite as db
+
+
+class Thing(db.Model):
+    number = db.IntegerProperty()
+
+
+class KeyOrderTest(support.TestCase):
+    def setUp(self):
+        super(KeyOrderTest, self).setUp()
+        db.delete(Thing.all(keys_only=True).fetch(100))
+
+    def test_ids_sort_by_value(self):
+        # The ids go from one to two digits.
+        ids = [3, 13, 9, 10, 1]
+        db.put([Thing(key=db.Key.from_path('Thing', id), number=id)
+                for id in ids])
+
+        keys = Thing.all(keys_only=True).order('__key__').fetch(10)
+        self.assertEqual([key.id() for key in keys], sorted(ids))
+
+        keys = Thing.all(keys_only=True).order('-__key__').fetch(10)
+        self.assertEqual([key.id() for key in keys], sorted(ids, reverse=True))
+
+        query = Thing.all(keys_only=True).order('__key__')
+        query.filter('__key__ >', db.Key.from_path('Thing', 3))
+        keys = query.fetch(10)
+        self.assertEqual([key.id() for key in keys], [9, 10, 13])
+
+    def test_encoded_keys_round_trip(self):
+        key = db.Key.from_path('Thing', 13, 'Thing', 'name')
+        self.assertEqual(db.Key(str(key)), key)
+        self.assertEqual(db.Key(str(key)).parent().id(), 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2010 Andreas Blixt
+#
+# This file is part of Storyteller.
+#
+# Storyteller is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# Storyteller is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Storyteller. If not, see http://www.gnu.org/licenses/.
+#
+
+import unittest
+
+import support
+
+from storyteller.backends import local_taskqueue
+
+
+class Request(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class LocalTaskQueueTest(support.TestCase):
+    def setUp(self):
+        super(LocalTaskQueueTest, self).setUp()
+        self.forget_tasks()
+        local_taskqueue._get_connection().execute('DELETE FROM tasks')
+
+    def tearDown(self):
+        self.forget_tasks()
+        local_taskqueue._get_connection().execute('DELETE FROM tasks')
+
+    def forget_tasks(self):
+        """Drops the queued tasks from memory, like exiting the process
+        would.
+
+        """
+        local_taskqueue._lock.acquire()
+        try:
+            del local_taskqueue._tasks[:]
+            local_taskqueue._queued.clear()
+            local_taskqueue._tombstones.clear()
+        finally:
+            local_taskqueue._lock.release()
+
+    def test_queued_tasks_are_restored(self):
+        local_taskqueue.add(url='/tasks/fold_votes', name='restored-task',
+                            params={'story_id': 1, 'number': 2},
+                            countdown=3600)
+        self.forget_tasks()
+
+        local_taskqueue._restore()
+        self.assertEqual(len(local_taskqueue._tasks), 1)
+        eta, id, name, url, params = local_taskqueue._tasks[0]
+        self.assertEqual((name, url, params),
+                         ('restored-task', '/tasks/fold_votes',
+                          {'story_id': 1, 'number': 2}))
+        self.assertRaises(local_taskqueue.TaskAlreadyExistsError,
+                          local_taskqueue.add, url='/tasks/fold_votes',
+                          name='restored-task')
+
+    def test_only_the_queue_may_send_tasks(self):
+        self.assertFalse(local_taskqueue.is_task_request(Request({})))
+        self.assertFalse(local_taskqueue.is_task_request(
+            Request({local_taskqueue.TASK_HEADER: 'guess'})))
+        self.assertTrue(local_taskqueue.is_task_request(
+            Request({local_taskqueue.TASK_HEADER:
+                     local_taskqueue._secret})))
+
+
+if __name__ == '__main__':
+    unittest.main()